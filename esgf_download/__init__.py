@@ -10,26 +10,144 @@ import logging
 import time
 import pdb
 import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.connection import HTTPConnection, HTTPSConnection
+from requests.packages.urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
 import urllib2
 import threading
 import os
 import signal
 import errno
 import sys
+import socket
+import calendar
 import sqlite3
-from collections import deque
+import json
+import SocketServer
+from collections import deque, namedtuple, OrderedDict
 import Queue
 import pyesgf
 from pyesgf.search import SearchConnection
 from pyesgf.logon import LogonManager
+from myproxy.client import MyProxyClient
+import OpenSSL
 import re
+from contextlib import contextmanager
 
 import hashlib
 from lxml import etree
 from pkg_resources import resource_stream
+from esgf_download.symlinks import SymlinkTree, split_filename
+from esgf_download.netcdf_header import NetCDFHeaderParser
+from esgf_download.search_cache import normalize_constraints
 
 log = logging.getLogger(__name__)
 
+# Phases each transfer is timed by, in order, and the transfert columns
+# their times (in seconds) are recorded in.
+transfer_phases = ['connect', 'ttfb', 'transfer', 'hash', 'writer_wait', 'close']
+
+# A waiting transfer held in a host's queue: just the fields a DownloadThread
+# needs, as a tuple, so that queues of many transfers stay small.
+PendingTransfer = namedtuple('PendingTransfer', ['transfert_id', 'location', 'local_image', 'checksum', 'checksum_type'])
+
+# Connections in use to a data node by all workers: one for each leased
+# transfer, and another for each of those which is hedged.
+host_connections_sql = ("SELECT COUNT(*) + IFNULL(SUM(hedged), 0) FROM transfert " +
+    "WHERE datanode = ? AND lease_owner IS NOT NULL AND lease_expiry >= ?")
+
+# Columns added to the schema since schema.sql was written. These are added
+# to existing databases by upgrade_schema.
+schema_columns = [('transfert', phase + '_time', 'REAL') for phase in transfer_phases] + [
+    ('transfert', 'lease_owner', 'TEXT'),
+    ('transfert', 'lease_expiry', 'REAL'),
+    ('transfert', 'hedged', 'INTEGER'),
+    ('transfert', 'experiment', 'TEXT'),
+    ('transfert', 'ensemble', 'TEXT'),
+    ('transfert', 'time_frequency', 'TEXT'),
+    ('transfert', 'time_start', 'INT'),
+    ('transfert', 'time_end', 'INT'),
+    ('transfert', 'master_id', 'TEXT'),
+    ('transfert', 'datanode', 'TEXT')]
+
+# Columns identifying the files of one version of a dataset for time range queries.
+time_range_group = ['model', 'experiment', 'ensemble', 'time_frequency', 'variable', 'version_xml_tag']
+
+def _same_group(a, b):
+    return " AND ".join(["%s.%s = %s.%s" % (a, c, b, c) for c in time_range_group])
+
+# Whether time (YYYYMMDDhhmm) s falls no later than the day after time e, in
+# any calendar; the day after the 28th or later may be the 1st of next month.
+_next_day_sql = ("({s}/10000 <= {e}/10000 + 1 OR (({e}/10000) % 100 >= 28 AND {s}/10000 <= " +
+    "CASE WHEN ({e}/1000000) % 100 = 12 THEN ({e}/100000000 + 1) * 10000 + 101 " +
+    "ELSE ({e}/1000000 + 1) * 100 + 1 END))")
+
+# Views, tables and indices added since schema.sql was written. These must be
+# safe to run against a database which already has them.
+schema_statements = [
+    # Dropped and recreated so that existing databases pick up changes to it.
+    "DROP VIEW IF EXISTS host_phase_times",
+    # Phases never recorded (eg all but connect and ttfb for a host whose
+    # transfers all failed) count as 0, as MAX() of several values is NULL
+    # if any of them is.
+    "CREATE VIEW host_phase_times AS " +
+    "SELECT datanode, COUNT(*) AS transfers, " +
+    ", ".join(["SUM(%s_time) AS %s_time" % (p, p) for p in transfer_phases]) + ", " +
+    "CASE MAX(" + ", ".join(["IFNULL(SUM(%s_time), 0)" % p for p in transfer_phases]) + ") " +
+    " ".join(["WHEN IFNULL(SUM(%s_time), 0) THEN '%s'" % (p, p) for p in transfer_phases]) + " END AS dominant_phase " +
+    "FROM transfert WHERE connect_time IS NOT NULL GROUP BY datanode",
+    "CREATE INDEX IF NOT EXISTS idx_transfert_lease on transfert (lease_owner)",
+    # Pages through the waiting transfers of each model on each data node in order.
+    "DROP INDEX IF EXISTS idx_transfert_pending",
+    "CREATE INDEX IF NOT EXISTS idx_transfert_host_pending on transfert (model, datanode, status, transfert_id)",
+    # Transfers are deduplicated by tracking_id when harvesting and importing manifests.
+    "CREATE INDEX IF NOT EXISTS idx_transfert_tracking on transfert (tracking_id)",
+    "CREATE INDEX IF NOT EXISTS idx_transfert_time on transfert (" + ",".join(time_range_group) + ",time_start)",
+    # Time span covered by each dataset.
+    "CREATE VIEW IF NOT EXISTS dataset_time_coverage AS " +
+    "SELECT " + ",".join(time_range_group) + ", COUNT(*) AS files, " +
+    "MIN(time_start) AS time_start, MAX(time_end) AS time_end " +
+    "FROM transfert WHERE time_start IS NOT NULL GROUP BY " + ",".join(time_range_group),
+    # Pairs of files of a dataset whose time ranges overlap.
+    "CREATE VIEW IF NOT EXISTS transfert_time_overlaps AS " +
+    "SELECT " + ",".join(["a." + c for c in time_range_group]) + ", " +
+    "a.transfert_id AS transfert_id, b.transfert_id AS other_transfert_id " +
+    "FROM transfert a JOIN transfert b ON " + _same_group('a', 'b') + " " +
+    "AND a.transfert_id < b.transfert_id AND a.time_start <= b.time_end AND b.time_start <= a.time_end",
+    # Files of a dataset which don't start by the day after earlier files end.
+    "CREATE VIEW IF NOT EXISTS transfert_time_gaps AS " +
+    "SELECT * FROM (SELECT " + ",".join(["a." + c for c in time_range_group]) + ", " +
+    "a.transfert_id AS transfert_id, a.time_start AS time_start, " +
+    "(SELECT MAX(b.time_end) FROM transfert b WHERE " + _same_group('a', 'b') + " " +
+    "AND b.time_start < a.time_start) AS previous_time_end FROM transfert a WHERE a.time_start IS NOT NULL) " +
+    "WHERE previous_time_end < time_start AND NOT " + _next_day_sql.format(s='time_start', e='previous_time_end'),
+    # Digests computed while downloading, besides the catalog's checksum.
+    "CREATE TABLE IF NOT EXISTS transfert_digest (transfert_id INTEGER, algorithm TEXT, digest TEXT, " +
+    "PRIMARY KEY (transfert_id, algorithm))",
+    # Every copy of each dataset version found when harvesting, and the one
+    # whose catalog the transfers were taken from (harvested = 1).
+    "CREATE TABLE IF NOT EXISTS dataset_replica (master_id TEXT, version TEXT, data_node TEXT, " +
+    "catalog_url TEXT, replica INT, harvested INT, PRIMARY KEY (master_id, version, data_node))",
+    # Harvests (one per search host and set of constraints), so that an
+    # interrupted harvest can be resumed.
+    "CREATE TABLE IF NOT EXISTS harvest (harvest_id INTEGER PRIMARY KEY, search_host TEXT, constraints TEXT, " +
+    "started REAL, finished REAL, UNIQUE (search_host, constraints))",
+    # Dataset versions each harvest has processed ('done') or failed to ('failed').
+    "CREATE TABLE IF NOT EXISTS harvest_dataset (harvest_id INTEGER, master_id TEXT, version TEXT, " +
+    "status TEXT, error_msg TEXT, processed REAL, PRIMARY KEY (harvest_id, master_id, version))"]
+
+def new_hash(algorithm):
+    '''
+    Creates a hash object for a checksum type as named in THREDDS catalogs
+    (eg MD5, SHA256 or SHA-256).
+    :param algorithm: Name of the algorithm.
+    :rtype: hashlib hash object.
+    :raises ValueError: If the algorithm isn't supported.
+    '''
+    if algorithm is None:
+        raise ValueError("no checksum type given")
+    return hashlib.new(algorithm.lower().replace('-', ''))
+
 def get_request(requests_object, url, **kwargs):
     '''
     Function which performs an HTTP GET request with a session object.
@@ -64,8 +182,10 @@ def get_request(requests_object, url, **kwargs):
     except error as e:
         raise Exception("UNKNOWN_ERROR: " + str(e))
 
-    # HTTP error handling
-    if(fetch_request.status_code != 200):
+    # HTTP error handling; 206 is the reply to a range request.
+    if(fetch_request.status_code not in (200, 206)):
+        # Release the connection so it can be reused.
+        fetch_request.close()
         response_dict = {403: "AUTH_FAIL", 404: "FILE_NOT_FOUND", 500: "SERVER_ERROR" }
         if fetch_request.status_code in response_dict:
             raise Exception(response_dict[fetch_request.status_code])
@@ -74,6 +194,44 @@ def get_request(requests_object, url, **kwargs):
 
     return fetch_request
 
+class PhaseTimer:
+    '''
+    Accumulates wall clock time spent in named phases of a task, along with
+    counts of things processed, so that time can be apportioned between
+    (for example) fetching, parsing and inserting.
+    '''
+    def __init__(self):
+        self.times = {}
+        self.counts = {}
+
+    @contextmanager
+    def phase(self, name):
+        '''
+        Context manager which adds the time spent in its body to the named phase.
+        :param name: Name of the phase.
+        '''
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.time() - start)
+
+    def add_time(self, name, seconds):
+        '''
+        Adds time to the named phase.
+        :param name: Name of the phase.
+        :param seconds: Time in seconds.
+        '''
+        self.times[name] = self.times.get(name, 0.0) + seconds
+
+    def count(self, name, n=1):
+        '''
+        Increments the named counter.
+        :param name: Name of the counter.
+        :param n: Amount to increment by.
+        '''
+        self.counts[name] = self.counts.get(name, 0) + n
+
 class MultiFileWriter:
     '''
     A write serializer which allows for many files to be open but for only one
@@ -152,7 +310,8 @@ class DownloadThread:
                  checksum_type,
                  writer,
                  event_queue,
-                 session):
+                 session,
+                 digests=()):
         '''
         Creates a DownloadThread and starts it.
         :param url: URL to download.
@@ -162,8 +321,12 @@ class DownloadThread:
         :param checksum: Checksum that the file should have when file is downloaded.
         :param writer: MultiFileWriter object which serializes writing.
         :param event_queue: A Queue to put events (failures to download,
-            successes, corruption) in.
+            successes, corruption) in. Progress isn't reported as events;
+            data_size counts the bytes received so far.
         :param session: The Requests session object to be used for auth.
+        :param digests: Names of further digests to compute as the data is
+            received. Once the download is done, self.digests maps each name
+            to its hex digest.
         '''
         ## Possibly use **kwargs + self.__dict assignment + self.__dict.update()
         self.checksum = checksum
@@ -175,12 +338,24 @@ class DownloadThread:
         self.writer = writer
         self.event_queue = event_queue
         self.session = session
+        self.digest_algorithms = digests
+        self.digests = {}
         self.data_size = 0
         self.perf_list = []
         self.num_recs = 5
         self.abort_lock = threading.Lock()
         self.abort = False
+        self.hedge_lock = threading.Lock()
+        self.chunk_lock = threading.Lock()
+        self.receiving = False
+        self.hedge_url = None
+        self.hedge = None
+        # Whether a host thread is held for the hedge; set and cleared by the Downloader.
+        self.hedge_slot = False
+        self.winner = None
         self.blocksize = 1024 * 1024
+        self.timer = PhaseTimer()
+        self.header_parser = NetCDFHeaderParser()
         self.download_thread = threading.Thread(target=self.download, name=filename)
         self.download_thread.daemon = True
         self.download_thread.start()
@@ -199,7 +374,8 @@ class DownloadThread:
 
     def _add_perf_num(self, kbps):
         '''
-        Add a record to the running mean download speed record. Internal.
+        Add a record to the running mean download speed record. Called as
+        the main thread samples progress. Internal.
         :param kbps: The download speed for the last interval in kbps.
         '''
         self.perf_list.append(kbps)
@@ -216,8 +392,51 @@ class DownloadThread:
         for item in self.perf_list:
             avg_perf += item
         return avg_perf / len(self.perf_list)
-        
-        
+
+    def request_hedge(self, url=None):
+        '''
+        Starts fetching the rest of this download over a second connection as
+        well, the first to finish winning. Does nothing if the download has
+        been hedged already, or isn't receiving data.
+        :param url: URL to fetch the rest from (eg another replica's);
+            defaults to the download's URL.
+        :rtype: True if a hedge was started.
+        '''
+        # The chunk lock keeps the byte count and digests consistent while
+        # they are copied, even if the download thread is mid-chunk.
+        with self.chunk_lock:
+            if self.hedge_url is None and self.receiving:
+                self.hedge_url = url or self.url
+                self.hedge = Hedge(self, self.hedge_url, self.data_size, self.data_hash, self.extra_hashes)
+                return True
+        return False
+
+    def hedge_failed(self):
+        '''
+        Allows the download to be hedged again once a hedge has failed.
+        '''
+        with self.chunk_lock:
+            self.hedge_url = None
+
+    def claim_win(self, who):
+        '''
+        Records which of the original request and the hedge finished first. Internal.
+        :param who: 'original' or 'hedge'.
+        :rtype: True if who finished first.
+        '''
+        with self.hedge_lock:
+            if self.winner is None:
+                self.winner = who
+            return self.winner == who
+
+    def _cancel_hedge(self):
+        '''
+        Stops the hedge and waits for it to finish. Internal.
+        '''
+        self.hedge.abort = True
+        shutdown_response(self.hedge.res)
+        self.hedge.thread.join()
+
     def download(self):
         '''
         Routine which comprises the main download task. Spawned as a thread. Internal.
@@ -225,19 +444,34 @@ class DownloadThread:
         log.info("Initializing download of " + self.filename)
         self._mark_start_time()
 
-        if self.checksum_type.lower() not in hashlib.algorithms:
+        # Every digest is computed in the same pass over the data.
+        try:
+            data_hash = new_hash(self.checksum_type)
+        except ValueError:
             self._mark_end_time()
             self.event_queue.put(("ERROR", self.transfert_id, "UNSUPPORTED_CHECKSUM_TYPE: {}".format(self.checksum_type)))
-        data_hash = hashlib.new(self.checksum_type.lower())
+            return
+        extra_hashes = dict((algorithm, new_hash(algorithm)) for algorithm in self.digest_algorithms)
+        self.data_hash, self.extra_hashes = data_hash, extra_hashes
 
+        # Connection setup (TCP and TLS handshakes, if the connection isn't
+        # reused) is timed as it happens; the rest of the wait for the
+        # response headers is the time to first byte.
         request_error = None
+        connection_setup.time = 0.0
+        request_start = time.time()
         try:
-            res = get_request(self.session, self.url, stream=True)
+            try:
+                res = get_request(self.session, self.url, stream=True)
+            finally:
+                self.timer.add_time('connect', connection_setup.time)
+                self.timer.add_time('ttfb', time.time() - request_start - connection_setup.time)
         except Exception as e:
             self._mark_end_time()
             self.event_queue.put(("ERROR", self.transfert_id, str(e)))
             return
         
+        self.res = res
         self.event_queue.put(("LENGTH", self.transfert_id, res.headers['content-length']))
 
         # Download data
@@ -258,32 +492,67 @@ class DownloadThread:
 
         # NOTE: What exceptions does this throw?
         # FIXME (related): Implement download resuming somehow.
+        # Time spent waiting on the network is whatever isn't spent writing
+        # or hashing.
         try:
             last_time = time.time()
+            self.receiving = True
             for chunk in res.iter_content(self.blocksize):
-                self.writer.enqueue(fd, chunk)
-                this_time = time.time()
-                self.event_queue.put((
-                    "SPEED",
-                    self.transfert_id,
-                    len(chunk) / (1024.0 * (this_time - last_time))))
-                self._add_perf_num((self.blocksize / 1024) / (this_time - last_time))
-                last_time = this_time
-                self.data_size += len(chunk)
-                data_hash.update(chunk)
+                self.timer.add_time('transfer', time.time() - last_time)
+                with self.timer.phase('writer_wait'):
+                    self.writer.enqueue(fd, chunk)
+                # Progress is only counted here; the main thread samples
+                # data_size (see Downloader.sample_progress), so that the
+                # event queue only carries changes of state.
+                with self.chunk_lock:
+                    self.data_size += len(chunk)
+                    with self.timer.phase('hash'):
+                        data_hash.update(chunk)
+                        for extra_hash in extra_hashes.values():
+                            extra_hash.update(chunk)
+                if not self.header_parser.done:
+                    self.header_parser.feed(chunk)
+                last_time = time.time()
+                if self.winner is not None:
+                    # The hedge finished first.
+                    break
                 if(self.abort):
                     raise Exception("Shutting down")
         except Exception as e:
-            try:
-                os.unlink(self.filename)
-            except Exception as e:
-                pass
-            self._mark_end_time()
-            self.event_queue.put(("ABORTED", self.transfert_id, 'Caught exception: ' + str(e)))
-            return
+            res.close()
+            with self.chunk_lock:
+                self.receiving = False
+            # If a hedge is running, it may yet finish the download; if it
+            # won, this request failed because the hedge shut it down.
+            if self.hedge is not None and not self.abort:
+                self.hedge.thread.join()
+            if self.winner != 'hedge':
+                if self.hedge is not None:
+                    self._cancel_hedge()
+                try:
+                    os.unlink(self.filename)
+                except Exception as e:
+                    pass
+                self._mark_end_time()
+                self.event_queue.put(("ABORTED", self.transfert_id, 'Caught exception: ' + str(e)))
+                return
+
+        with self.chunk_lock:
+            self.receiving = False
 
         # Ensure the FD gets closed
-        self.writer.enqueue(fd, "", last=True)
+        with self.timer.phase('close'):
+            self.writer.enqueue(fd, "", last=True)
+            res.close()
+            if self.hedge is not None:
+                if self.claim_win('original'):
+                    self._cancel_hedge()
+                else:
+                    # The hedge wrote the rest of the file; its digests cover
+                    # what this request received before it started.
+                    self.hedge.thread.join()
+                    data_hash, extra_hashes = self.hedge.data_hash, self.hedge.extra_hashes
+                    self.data_size = self.hedge.offset + self.hedge.data_size
         self._mark_end_time()
 
         if data_hash.hexdigest() != self.checksum:
@@ -291,29 +560,225 @@ class DownloadThread:
             self._mark_end_time()
             self.event_queue.put(("ERROR", self.transfert_id, "CHECKSUM_MISMATCH_ERROR"))
             return
+        self.digests = dict((algorithm, extra_hash.hexdigest()) for algorithm, extra_hash in extra_hashes.items())
 
         # Note: Not closing the file is deliberate. The writer closes the file.
         self.event_queue.put((
             "DONE",
             self.transfert_id,
-            (self.data_size / 1024) / (self.start_time - self.end_time)))
+            (self.data_size / 1024) / (self.end_time - self.start_time)))
 
 
+class Hedge:
+    '''
+    A second request for the rest of a straggling download. Its data is
+    written to the download's file at the same offsets as the original
+    request's, so whichever finishes first leaves the file complete; the
+    winner shuts down the loser's connection.
+    '''
+    def __init__(self, download, url, offset, data_hash, extra_hashes):
+        '''
+        Creates a Hedge and starts it.
+        :param download: The DownloadThread whose download to hedge.
+        :param url: URL to fetch the rest of the file from.
+        :param offset: Number of bytes the original request has received.
+        :param data_hash: Hash object for the checksum over the bytes received;
+            it is copied, so the original request can carry on with it.
+        :param extra_hashes: Dictionary of further digest names to hash objects, likewise.
+        '''
+        self.download = download
+        self.url = url
+        self.offset = offset
+        self.data_hash = data_hash.copy()
+        self.extra_hashes = dict((algorithm, h.copy()) for algorithm, h in extra_hashes.items())
+        self.data_size = 0
+        self.res = None
+        self.abort = False
+        log.info("Hedging download of %s from byte %d" % (download.filename, offset))
+        self.thread = threading.Thread(target=self.fetch, name=download.filename + " (hedge)")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def fetch(self):
+        '''
+        Routine which fetches the rest of the file. Spawned as a thread. Internal.
+        '''
+        fd = None
+        try:
+            self.res = get_request(self.download.session, self.url, stream=True,
+                                   headers={ 'Range': 'bytes=%d-' % self.offset })
+            if self.res.status_code != 206:
+                raise Exception("RANGE_NOT_SUPPORTED")
+            fd = open(self.download.filename, "r+b")
+            fd.seek(self.offset)
+            for chunk in self.res.iter_content(self.download.blocksize):
+                if self.abort:
+                    raise Exception("Cancelled")
+                self.download.writer.enqueue(fd, chunk)
+                self.data_hash.update(chunk)
+                for extra_hash in self.extra_hashes.values():
+                    extra_hash.update(chunk)
+                self.data_size += len(chunk)
+            self.download.writer.enqueue(fd, "", last=True)
+            fd = None
+            self.res.close()
+            if self.download.claim_win('hedge'):
+                log.info("Hedge finished first for " + self.download.filename)
+                shutdown_response(self.download.res)
+        except Exception as e:
+            if fd is not None:
+                self.download.writer.enqueue(fd, "", last=True)
+            if self.res is not None:
+                self.res.close()
+            if not self.abort:
+                log.info("Hedge failed for " + self.download.filename + ": " + str(e))
+                # The download finishes only after this thread, so this
+                # event is always handled before the download's last.
+                self.download.event_queue.put(("HEDGE_FAILED", self.download.transfert_id, str(e)))
+
 class Host:
     '''
     Describes a host's parameters (maximum threads, data node).
     '''
-    def __init__(self, max_thread_count, datanode):
+    def __init__(self, max_thread_count, datanode, spawn_interval=0.0):
         '''
         Creates a Host object.
         :param max_thread_count: The maximum number of download threads to use for this host.
         :param datanode: The base URL for the data node.
+        :param spawn_interval: Minimum time in seconds between starting downloads from this host.
         '''
         self.max_thread_count = max_thread_count
         self.datanode = datanode
         self.thread_count = 0
-        self.session = make_session()
+        self.paused = False
+        self.session = make_session(max_thread_count)
+        # A window onto the host's waiting transfers, refilled from the
+        # database as it empties. The highest transfert_id read so far is kept
+        # for each of the host's models, along with the models known to have
+        # no more waiting transfers.
         self.download_queue = deque()
+        self.cursors = {}
+        self.exhausted = set()
+        self.spawn_interval = spawn_interval
+        self.last_spawn_time = 0.0
+        # Times at which threads finished while transfers were queued; a
+        # slot is idle from then until a download is started in it.
+        self.free_slot_times = deque()
+        self.slot_idle_time = 0.0
+        # Rates (bytes/s) of the most recent completed transfers.
+        self.recent_rates = deque(maxlen=20)
+        # Cleared when a hedge finds the host doesn't support range requests.
+        self.range_requests = True
+
+    def note_waiting(self, model, first_id=None, last_id=None):
+        '''
+        Notes that one of this host's models may have waiting transfers which
+        haven't been read into the queue.
+        :param model: Name of the model.
+        :param first_id: Lowest transfert_id which may be waiting, if
+            transfers already read may be waiting again; otherwise None.
+        :param last_id: Highest transfert_id waiting, if known.
+        '''
+        cursor = self.cursors.setdefault(model, 0)
+        if first_id is not None and first_id <= cursor:
+            self.cursors[model] = first_id - 1
+        if last_id is None or last_id > self.cursors[model]:
+            self.exhausted.discard(model)
+
+    def has_pending(self):
+        '''
+        Tells whether this host may have waiting transfers, whether queued or still in the database.
+        :rtype: Boolean.
+        '''
+        return len(self.download_queue) > 0 or len(self.exhausted) < len(self.cursors)
+
+    def next_spawn_time(self):
+        '''
+        Returns the earliest time at which another download may be started from this host.
+        :rtype: Time in seconds since the epoch.
+        '''
+        return self.last_spawn_time + self.spawn_interval
+
+    def slot_freed(self, when):
+        '''
+        Notes that a thread finished, so that the time until its slot is
+        reused can be counted as idle if transfers are waiting.
+        :param when: Time at which the thread finished.
+        '''
+        if self.has_pending():
+            self.free_slot_times.append(when)
+
+    def slot_filled(self, now):
+        '''
+        Notes that a download was started, ending the idle period of the
+        slot freed longest ago.
+        :param now: Time at which the download was started.
+        :rtype: Time in seconds the slot was idle, or None if no slot was idle.
+        '''
+        self.last_spawn_time = now
+        if len(self.free_slot_times) == 0:
+            return None
+        idle = now - self.free_slot_times.popleft()
+        self.slot_idle_time += idle
+        return idle
+
+    def set_max_thread_count(self, max_thread_count):
+        '''
+        Changes the maximum number of download threads for this host, growing
+        the session's connection pool if it is now too small.
+        :param max_thread_count: The maximum number of download threads to use for this host.
+        '''
+        if max_thread_count > self.max_thread_count:
+            size_connection_pools(self.session, max_thread_count)
+        self.max_thread_count = max_thread_count
+
+    def connection_stats(self):
+        '''
+        Counts connections opened and reused by this host's session.
+        :rtype: Dictionary with the number of 'new' and 'reused' connections.
+        '''
+        return session_connection_stats(self.session)
+
+class ControlRequestHandler(SocketServer.StreamRequestHandler):
+    '''
+    Handles a connection to a Downloader's control socket. Each line received
+    is a command; each reply is a line of JSON. Commands are passed to the
+    Downloader's main thread to be carried out, so that all changes to its
+    state happen there.
+    '''
+    def handle(self):
+        # Not 'for line in self.rfile', which reads ahead and so waits for
+        # more than one command before handling the first.
+        for line in iter(self.rfile.readline, ''):
+            command = line.split()
+            if len(command) == 0:
+                continue
+            reply_queue = Queue.Queue()
+            self.server.downloader.control_queue.put((command, reply_queue))
+            self.server.downloader.wake()
+            try:
+                reply = reply_queue.get(timeout=30)
+            except Queue.Empty:
+                reply = { 'error': 'TIMEOUT' }
+            self.wfile.write(json.dumps(reply) + "\n")
+            self.wfile.flush()
+
+class ControlServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    '''
+    A Unix socket server through which a running Downloader can be retuned.
+    '''
+    daemon_threads = True
+
+    def __init__(self, socket_path, downloader):
+        '''
+        Creates a ControlServer.
+        :param socket_path: Path of the Unix socket to listen on.
+        :param downloader: The Downloader to control.
+        '''
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        SocketServer.UnixStreamServer.__init__(self, socket_path, ControlRequestHandler)
+        self.downloader = downloader
 
 class Downloader:
     '''
@@ -328,9 +793,27 @@ class Downloader:
                  auth_server,
                  initial_threads_per_host=3,
                  max_total_threads=100,
+                 worker_id=None,
+                 lease_duration=300,
+                 control_socket=None,
+                 renew_credentials_before=3600,
+                 symlink_root=None,
+                 spawn_interval=0.0,
+                 pending_window=100,
+                 digests=None,
+                 hedge_threshold=0.25,
+                 hedge_after=60,
                  **kwargs):
         '''
         Creates a Downloader object.
+
+        Several Downloaders (in several processes, or on several nodes sharing
+        the database file) may work on the same database. Each transfer is
+        claimed with a lease before it is started; leases are renewed while the
+        transfer runs, and transfers whose leases expire (because their worker
+        died) are returned to the 'waiting' state. Per-host thread limits are
+        counted over the leases held by all workers.
+
         :param database_file: Sqlite3 database file where information
             is stored on files to be downloaded.
         :param base_path: Base path to store downloaded files in.
@@ -339,6 +822,32 @@ class Downloader:
         :param auth_server: Authentication server to use to authenticate.
         :param initial_threads_per_host: Initial number of threads per host.
         :param max_total_threads: Maximum number of independent downloads.
+        :param worker_id: Identifier recorded as the owner of leases taken by
+            this Downloader. Defaults to hostname:pid.
+        :param lease_duration: Time in seconds a lease lasts without renewal.
+        :param control_socket: Path of a Unix socket on which to accept
+            commands to retune the Downloader while it runs. See control_command.
+        :param renew_credentials_before: Time in seconds before the
+            credentials expire at which to renew them. Transfers which failed
+            with AUTH_FAIL are requeued when the credentials are renewed.
+        :param symlink_root: Root directory of a symlink tree to keep up to
+            date as downloads complete. See SymlinkTree.
+        :param spawn_interval: Minimum time in seconds between starting
+            downloads from any one host. Can be changed per host through the
+            control socket.
+        :param pending_window: Number of waiting transfers per host to hold
+            in memory. Waiting transfers are read from the database a window
+            at a time as downloads are started.
+        :param digests: Names of digests (eg sha256) to compute as files are
+            downloaded, in addition to the checksum given in the catalog, and
+            record in the transfert_digest table.
+        :param hedge_threshold: A transfer whose rate falls below this
+            fraction of the median rate of its host's transfers is a
+            straggler, and the rest of it is fetched over a second connection
+            as well, the first to finish winning. 0 disables this.
+        :param hedge_after: Time in seconds a transfer must have been running
+            before it can be considered a straggler.
+        :raises ValueError: If one of the digests isn't supported.
         '''
         self.base_path = base_path
         self.username = username
@@ -348,15 +857,45 @@ class Downloader:
         self.initial_threads_per_host = initial_threads_per_host
         self.max_total_threads = max_total_threads
         self.total_threads = 0
+        self.worker_id = worker_id or "%s:%d" % (socket.gethostname(), os.getpid())
+        self.lease_duration = lease_duration
+        self.control_socket = control_socket
+        self.draining = False
+        self.renew_credentials_before = renew_credentials_before
+        self.check_credentials_now = threading.Event()
+        self.credentials_renewed = threading.Event()
+        # Transfers which fail with AUTH_FAIL after this time are requeued
+        # when the credentials are next renewed.
+        self.last_credentials_renewal = time.time()
+        self.symlink_tree = None
+        if symlink_root is not None:
+            self.symlink_tree = SymlinkTree(base_path, symlink_root)
+        self.spawn_interval = spawn_interval
+        self.pending_window = pending_window
+        self.hedge_threshold = hedge_threshold
+        self.hedge_after = hedge_after
+        self.last_straggler_check = time.time()
+        self.last_progress_sample = time.time()
+        self.digests = [ d.lower().replace('-', '') for d in (digests or []) ]
+        for digest in self.digests:
+            try:
+                new_hash(digest)
+            except ValueError:
+                raise ValueError("Unsupported digest: " + digest)
+        # Scheduling statistics: 'event_latency' is the time from a download
+        # thread finishing to this thread handling it, 'slot_idle' the time
+        # from a slot being freed to a queued transfer being started in it.
+        self.scheduler_timer = PhaseTimer()
 
         # Database jazz. 2 connections due to Python limitations; lock due to not using WAL yet.
-        self.conn = sqlite3.connect(database_file)
+        self.conn = open_database(database_file, timeout=60)
         self.database_lock = threading.Lock()
         self.database_file = database_file
 
-        # Queues for incoming metadata and events
+        # Queues for notices of waiting transfers and for events
         self.event_queue = Queue.Queue()
         self.metadata_queue = Queue.Queue()
+        self.control_queue = Queue.Queue()
 
         # Queues per model, and collections of threads.
         self.download_threads = {}
@@ -364,25 +903,23 @@ class Downloader:
 
     def metadata_reader(self):
         '''
-        Routine which retrieves metadata and places it into a queue to be processed.
-        Spawned as a thread. Internal.
+        Routine which finds models with waiting transfers on each data node
+        and notifies the main thread of them through a queue; the transfers
+        themselves are read a window at a time by fill_queue. Spawned as a
+        thread. Internal.
         '''
         log.debug("Starting metadata reader...")
-        last_transfert_id = 0
-        reader_conn = sqlite3.connect(self.database_file)
-        reader_conn.row_factory = sqlite3.Row
-        curse = reader_conn.cursor()
+        reader_conn = sqlite3.connect(self.database_file, timeout=60)
 
-        # FIXME: The method used here is kind of wrong. It should check for anything that's
-        # changed; but instead it only checks for stuff that's new.
         while self.running:
             try:
                 with self.database_lock:
-                    for row in curse.execute("SELECT transfert.*,model.* " +
-                        "FROM transfert JOIN model ON model.name=transfert.model " +
-                        "WHERE status = 'waiting' AND transfert_id > ?", [last_transfert_id]):
-                        self.metadata_queue.put(row)
-                        last_transfert_id = max(row['transfert_id'], last_transfert_id)
+                    self.notify_waiting(self.reclaim_expired_leases(reader_conn))
+                    for name, datanode, last_id in reader_conn.execute(
+                            "SELECT model, datanode, MAX(transfert_id) FROM transfert " +
+                            "WHERE status = 'waiting' GROUP BY model, datanode").fetchall():
+                        self.metadata_queue.put((name, datanode, None, last_id))
+                self.wake()
             except sqlite3.Error as se:
                 log.error("Error querying for new transfers; shutting down.")
                 self.running = False
@@ -390,46 +927,215 @@ class Downloader:
             time.sleep(60)
         log.debug("Metadata reader exiting...")
 
-    def handle_events(self):
+    def notify_waiting(self, transfers):
+        '''
+        Notifies the main thread that transfers already read into host queues
+        (or skipped) are waiting again, so that they are read again. Internal.
+        :param transfers: List of (transfert_id, model, datanode) tuples.
+        '''
+        first_ids = {}
+        for transfert_id, model, datanode in transfers:
+            key = (model, datanode)
+            first_ids[key] = min(first_ids.get(key, transfert_id), transfert_id)
+        for (model, datanode), first_id in first_ids.items():
+            self.metadata_queue.put((model, datanode, first_id, None))
+
+    def reclaim_expired_leases(self, conn):
+        '''
+        Returns transfers whose leases have expired (because the worker holding
+        them died) to the 'waiting' state. Internal.
+        :param conn: The sqlite3 connection to use.
+        :rtype: List of (transfert_id, model, datanode) tuples for the transfers reclaimed.
+        '''
+        now = time.time()
+        expired = conn.execute(
+            "SELECT transfert_id, model, datanode FROM transfert " +
+            "WHERE lease_owner IS NOT NULL AND lease_expiry < ?", [now]).fetchall()
+        if len(expired) > 0:
+            log.info("Reclaiming %d transfers with expired leases" % len(expired))
+            conn.execute(
+                "UPDATE transfert SET status = 'waiting', lease_owner = NULL, lease_expiry = NULL " +
+                "WHERE lease_owner IS NOT NULL AND lease_expiry < ?", [now])
+            conn.commit()
+        return expired
+
+    def release_own_leases(self):
+        '''
+        Returns transfers leased to this Downloader's worker_id to the
+        'waiting' state. Run at startup: any such leases were taken by an
+        earlier fetcher with the same worker_id which died, and no thread is
+        running their transfers, so renewing them would hold them forever.
+        Internal.
+        '''
+        with self.database_lock:
+            released = self.conn.execute(
+                "UPDATE transfert SET status = 'waiting', lease_owner = NULL, lease_expiry = NULL " +
+                "WHERE lease_owner = ?", [self.worker_id]).rowcount
+            self.conn.commit()
+        if released > 0:
+            log.info("Released %d transfers left leased to %s by an earlier run" % (released, self.worker_id))
+
+    def lease_renewer(self):
+        '''
+        Routine which periodically renews the leases on transfers held by this
+        Downloader. Spawned as a thread. Internal.
+        '''
+        log.debug("Starting lease renewer...")
+        renewer_conn = sqlite3.connect(self.database_file, timeout=60)
+        while self.running:
+            time.sleep(self.lease_duration / 3.0)
+            try:
+                with self.database_lock:
+                    renewer_conn.execute(
+                        "UPDATE transfert SET lease_expiry = ? WHERE lease_owner = ?",
+                        [time.time() + self.lease_duration, self.worker_id])
+                    renewer_conn.commit()
+            except sqlite3.Error as se:
+                log.warning("Error renewing leases: " + str(se))
+        log.debug("Lease renewer exiting...")
+
+    def claim(self, transfert_id, host):
+        '''
+        Claims a transfer for this Downloader by taking out a lease on it, if
+        no other worker holds a lease on it and the host has a free thread
+        across all workers. Internal.
+        :param transfert_id: Database ID of the transfer.
+        :param host: The Host the transfer is to be downloaded from.
+        :rtype: True if the transfer was claimed, False if it was taken by
+            another worker, or None if the host has no free threads.
+        '''
+        now = time.time()
+        with self.database_lock:
+            claimed = self.conn.execute(
+                "UPDATE transfert SET lease_owner = ?, lease_expiry = ?, hedged = NULL " +
+                "WHERE transfert_id = ? AND status = 'waiting' " +
+                "AND (lease_owner IS NULL OR lease_expiry < ?) " +
+                "AND (" + host_connections_sql + ") < ?",
+                [self.worker_id, now + self.lease_duration, transfert_id, now,
+                 host.datanode, now, host.max_thread_count]).rowcount == 1
+            self.conn.commit()
+            if claimed:
+                return True
+            (host_leases,) = self.conn.execute(host_connections_sql, [host.datanode, now]).fetchone()
+        if host_leases >= host.max_thread_count:
+            return None
+        return False
+
+    def fill_queue(self, host):
+        '''
+        Tops up a host's queue with the next waiting transfers of each of its
+        models, paging through them in transfert_id order. Internal.
+        :param host: The Host whose queue to fill.
+        '''
+        now = time.time()
+        # Cursors can be moved back over transfers already queued.
+        queued = set(item.transfert_id for item in host.download_queue)
+        for model in sorted(host.cursors.keys()):
+            wanted = self.pending_window - len(host.download_queue)
+            if wanted <= 0:
+                break
+            if model in host.exhausted:
+                continue
+            with self.database_lock:
+                rows = self.conn.execute(
+                    "SELECT " + ",".join(PendingTransfer._fields) + " FROM transfert " +
+                    "WHERE model = ? AND datanode = ? AND status = 'waiting' AND transfert_id > ? " +
+                    "AND (lease_owner IS NULL OR lease_expiry < ?) " +
+                    "ORDER BY transfert_id LIMIT ?",
+                    [model, host.datanode, host.cursors[model], now, wanted]).fetchall()
+            if len(rows) < wanted:
+                host.exhausted.add(model)
+            if len(rows) > 0:
+                host.cursors[model] = rows[-1][0]
+                host.download_queue.extend(PendingTransfer._make(row) for row in rows if row[0] not in queued)
+
+    def wake(self):
+        '''
+        Wakes the main thread if it is waiting for events, so that it sees
+        new transfers, control commands or renewed credentials. Safe to call
+        from any thread other than the main thread.
+        '''
+        self.event_queue.put(("WAKE", None, None))
+
+    def handle_events(self, timeout=0):
         '''
         Routine which appropriately dequeues and handles events passed back from download threads. Internal.
+        :param timeout: Time in seconds to wait for the first event if none are queued.
         '''
-        while not self.event_queue.empty():
+        block = timeout > 0
+        while True:
             try:
-                ev, transfert_id, data = self.event_queue.get(timeout=5)
-            except Exception as e:
+                ev, transfert_id, data = self.event_queue.get(block, timeout)
+            except Queue.Empty:
+                break
+            block = False
+            if ev == "WAKE":
                 continue
             thread = self.download_threads[transfert_id]
             update_fields = None
 
-            if ev == "ERROR":
+            if ev == "HEDGE_FAILED":
+                # Give back the hedge's thread, here and to other workers.
+                host = self.hosts[thread.host]
+                if thread.hedge_slot:
+                    thread.hedge_slot = False
+                    host.slot_freed(time.time())
+                    host.thread_count -= 1
+                    self.total_threads -= 1
+                    with self.database_lock:
+                        self.conn.execute("UPDATE transfert SET hedged = NULL WHERE transfert_id = ?", [transfert_id])
+                        self.conn.commit()
+                if data == "RANGE_NOT_SUPPORTED":
+                    log.info("Not hedging downloads from %s, which doesn't support range requests" % thread.host)
+                    host.range_requests = False
+                thread.hedge_failed()
+                self.scheduler_timer.count('hedges_failed')
+            elif ev == "ERROR":
                 # TODO: Add more appropriate error handling
                 # Specifically, something that behaves differently depending on the error message
                 # so that we can realize when a connection's been reset, etc, and can respond
                 # appropriately by scaling back # threads.
                 log.warning("Error downloading " + thread.url + ": " + data)
                 update_fields = { 'status': 'error', 'error_msg': data }
+                if data == "AUTH_FAIL":
+                    # Maybe the credentials expired sooner than expected.
+                    self.check_credentials_now.set()
             elif ev == "LENGTH":
                 update_fields = { 'status': 'running' }
                 thread.length = data
-            elif ev == "SPEED":
-                log.debug("ID: " + str(transfert_id) + ", Speed: " + str(data) + "kb/s")
             elif ev == "ABORTED":
                 log.error("Download aborted: " + thread.filename + ", Reason: " + data)
                 update_fields = { 'status': 'waiting' }
             elif ev == "DONE":
                 log.info("Finished downloading " + thread.filename)
                 update_fields = { 'status': 'done' }
+                if thread.end_time > thread.start_time:
+                    self.hosts[thread.host].recent_rates.append(thread.data_size / (thread.end_time - thread.start_time))
+                if thread.winner == 'hedge':
+                    self.scheduler_timer.count('hedges_won')
+                update_fields.update(thread.header_parser.dimension_fields())
         
             if update_fields is not None:
                 if update_fields['status'] != 'running':
                     update_fields['duration'] = thread.end_time - thread.start_time
-                    update_fields['rate'] = thread.data_size / update_fields['duration']
+                    if update_fields['duration'] > 0:
+                        update_fields['rate'] = thread.data_size / update_fields['duration']
                     update_fields['start_date'] = thread.start_time
                     update_fields['end_date'] = thread.end_time
+                    for phase in transfer_phases:
+                        update_fields[phase + '_time'] = thread.timer.times.get(phase)
+                    update_fields['lease_owner'] = None
+                    update_fields['lease_expiry'] = None
+                    update_fields['hedged'] = None
                     thread.download_thread.join()
-                    self.hosts[thread.host].thread_count -= 1
-                    self.total_threads -= 1
+                    self.scheduler_timer.add_time('event_latency', time.time() - thread.end_time)
+                    self.scheduler_timer.count('events')
+                    # A hedged download held a second thread for its hedge.
+                    slots = 2 if thread.hedge_slot else 1
+                    for i in range(slots):
+                        self.hosts[thread.host].slot_freed(thread.end_time)
+                    self.hosts[thread.host].thread_count -= slots
+                    self.total_threads -= slots
                     del self.download_threads[transfert_id]
                 with self.database_lock:
                     try:
@@ -437,6 +1143,10 @@ class Downloader:
                             'UPDATE transfert ' +
                             'SET ' + ",".join([ x + " = ?" for x in update_fields.keys() ]) +
                             ' WHERE transfert_id = ?', update_fields.values() + [transfert_id])
+                        if ev == "DONE":
+                            self.conn.executemany(
+                                "INSERT OR REPLACE INTO transfert_digest(transfert_id, algorithm, digest) VALUES (?, ?, ?)",
+                                [ (transfert_id, algorithm, digest) for algorithm, digest in thread.digests.items() ])
                         self.conn.commit()
                     except sqlite3.Error as se:
                         if not self.stop_now:
@@ -445,6 +1155,189 @@ class Downloader:
                             self.shutdown_now(None, None)
                             break
 
+                if ev == "DONE" and self.symlink_tree is not None:
+                    try:
+                        with self.database_lock:
+                            self.symlink_tree.update(self.conn, os.path.relpath(thread.filename, self.base_path))
+                    except (OSError, sqlite3.Error) as e:
+                        log.warning("Error updating symlink tree for " + thread.filename + ": " + str(e))
+
+    def control_command(self, command):
+        '''
+        Carries out a command received on the control socket. Internal.
+
+        Commands are:
+         * status: Report the state of hosts and download threads.
+         * set max_total_threads <n>: Change the global thread limit.
+         * set threads_per_host <n>: Change the thread limit for all hosts,
+           including hosts seen later.
+         * set host <datanode> <n>: Change the thread limit for one host.
+         * set spawn_interval <s>: Change the minimum time between starting
+           downloads from a host, for all hosts including hosts seen later.
+         * set host_spawn_interval <datanode> <s>: Change the minimum time
+           between starting downloads from one host.
+         * pause <datanode>, resume <datanode>: Stop or restart starting
+           new downloads from a host.
+         * drain: Finish downloads in progress, start no new ones, and exit.
+
+        :param command: The command, split into words.
+        :rtype: Dictionary to be returned to the client as JSON.
+        '''
+        name, args = command[0], command[1:]
+        try:
+            if name == 'status':
+                return {
+                    'worker_id': self.worker_id,
+                    'draining': self.draining,
+                    'total_threads': self.total_threads,
+                    'max_total_threads': self.max_total_threads,
+                    'threads_per_host': self.initial_threads_per_host,
+                    'spawn_interval': self.spawn_interval,
+                    'scheduler': {
+                        'events': self.scheduler_timer.counts.get('events', 0),
+                        'event_latency': self.scheduler_timer.times.get('event_latency', 0.0),
+                        'spawns': self.scheduler_timer.counts.get('spawns', 0),
+                        'idle_slots_filled': self.scheduler_timer.counts.get('idle_slots_filled', 0),
+                        'slot_idle': self.scheduler_timer.times.get('slot_idle', 0.0),
+                        'hedges': self.scheduler_timer.counts.get('hedges', 0),
+                        'hedges_won': self.scheduler_timer.counts.get('hedges_won', 0),
+                        'hedges_failed': self.scheduler_timer.counts.get('hedges_failed', 0),
+                        'progress_samples': self.scheduler_timer.counts.get('progress_samples', 0) },
+                    'hosts': dict((hostname, {
+                        'thread_count': host.thread_count,
+                        'max_thread_count': host.max_thread_count,
+                        'spawn_interval': host.spawn_interval,
+                        'queued': len(host.download_queue),
+                        'paused': host.paused,
+                        'slot_idle': host.slot_idle_time,
+                        'connections': host.connection_stats() }) for hostname, host in self.hosts.items()),
+                    'download_threads': dict((transfert_id, {
+                        'host': thread.host,
+                        'filename': thread.filename,
+                        'bytes': thread.data_size,
+                        'kbps': thread.get_avg_perf() if len(thread.perf_list) > 0 else None,
+                        'started': getattr(thread, 'start_time', None) }) for transfert_id, thread in self.download_threads.items()) }
+            elif name == 'set' and len(args) == 2 and args[0] == 'max_total_threads':
+                self.max_total_threads = int(args[1])
+            elif name == 'set' and len(args) == 2 and args[0] == 'threads_per_host':
+                self.initial_threads_per_host = int(args[1])
+                for host in self.hosts.values():
+                    host.set_max_thread_count(self.initial_threads_per_host)
+            elif name == 'set' and len(args) == 3 and args[0] == 'host':
+                self.hosts[args[1]].set_max_thread_count(int(args[2]))
+            elif name == 'set' and len(args) == 2 and args[0] == 'spawn_interval':
+                self.spawn_interval = float(args[1])
+                for host in self.hosts.values():
+                    host.spawn_interval = self.spawn_interval
+            elif name == 'set' and len(args) == 3 and args[0] == 'host_spawn_interval':
+                self.hosts[args[1]].spawn_interval = float(args[2])
+            elif name in ('pause', 'resume') and len(args) == 1:
+                self.hosts[args[0]].paused = (name == 'pause')
+            elif name == 'drain' and len(args) == 0:
+                log.info("Draining: finishing downloads in progress and starting no new ones.")
+                self.draining = True
+            else:
+                return { 'error': 'UNKNOWN_COMMAND: ' + " ".join(command) }
+        except KeyError as e:
+            return { 'error': 'UNKNOWN_HOST: ' + str(e) }
+        except ValueError as e:
+            return { 'error': 'BAD_VALUE: ' + str(e) }
+        log.info("Control command: " + " ".join(command))
+        return { 'ok': True }
+
+    def handle_control(self):
+        '''
+        Routine which carries out commands received on the control socket. Internal.
+        '''
+        while not self.control_queue.empty():
+            command, reply_queue = self.control_queue.get()
+            reply_queue.put(self.control_command(command))
+
+    def sample_progress(self, interval=5):
+        '''
+        Samples each transfer's byte count, adding the rate since the last
+        sample to the transfer's running mean. Download threads only count the bytes they receive;
+        sampling them here keeps per-chunk traffic off the event queue.
+        Internal.
+        :param interval: Minimum time in seconds between samples.
+        '''
+        now = time.time()
+        if now - self.last_progress_sample < interval:
+            return
+        self.last_progress_sample = now
+        self.scheduler_timer.count('progress_samples')
+        for transfert_id, thread in self.download_threads.items():
+            last_bytes, last_time = getattr(thread, 'last_sample', (0, getattr(thread, 'start_time', now)))
+            data_size = thread.data_size
+            thread.last_sample = (data_size, now)
+            if now > last_time and thread.receiving and data_size >= last_bytes:
+                kbps = (data_size - last_bytes) / (1024.0 * (now - last_time))
+                thread._add_perf_num(kbps)
+                log.debug("ID: " + str(transfert_id) + ", Speed: " + str(kbps) + "kb/s")
+
+    def check_stragglers(self, interval=10):
+        '''
+        Finds transfers running far slower than the others from their host,
+        and hedges them. Each transfer's rate is its running mean speed over
+        the last few samples taken by sample_progress, so that stalled
+        transfers are caught; a host's median is taken over those rates and
+        the rates of its recent completed transfers. Internal.
+        :param interval: Minimum time in seconds between checks.
+        '''
+        now = time.time()
+        if self.hedge_threshold <= 0 or now - self.last_straggler_check < interval:
+            return
+        self.last_straggler_check = now
+        rates = dict((thread, thread.get_avg_perf() * 1024) for thread in self.download_threads.values()
+                     if len(thread.perf_list) > 0)
+
+        for hostname, host in self.hosts.items():
+            host_rates = list(host.recent_rates) + [ rate for thread, rate in rates.items() if thread.host == hostname ]
+            if len(host_rates) < 3:
+                continue
+            median = sorted(host_rates)[len(host_rates) // 2]
+            for thread, rate in rates.items():
+                if (thread.host == hostname and host.range_requests and thread.hedge_url is None and thread.receiving
+                        and rate < self.hedge_threshold * median
+                        and now - thread.start_time > self.hedge_after
+                        and thread.data_size < int(getattr(thread, 'length', 0) or 0)):
+                    log.info("Straggler: %s at %.1f kB/s against a median of %.1f kB/s for %s" % (
+                        thread.filename, rate / 1024, median / 1024, hostname))
+                    if self.start_hedge(thread, host):
+                        self.scheduler_timer.count('hedges')
+                    else:
+                        log.info("No thread free for %s to hedge %s" % (hostname, thread.filename))
+
+    def start_hedge(self, thread, host):
+        '''
+        Hedges a download if its host has a thread free for the hedge's
+        connection, counting the threads of all workers. The hedge holds
+        the thread until the download finishes, or until the hedge fails.
+        Internal.
+        :param thread: The DownloadThread to hedge.
+        :param host: The Host it is downloading from.
+        :rtype: True if the hedge was started.
+        '''
+        if host.thread_count >= host.max_thread_count or self.total_threads >= self.max_total_threads:
+            return False
+        with self.database_lock:
+            reserved = self.conn.execute(
+                "UPDATE transfert SET hedged = 1 WHERE transfert_id = ? AND lease_owner = ? " +
+                "AND (" + host_connections_sql + ") < ?",
+                [thread.transfert_id, self.worker_id, host.datanode, time.time(), host.max_thread_count]).rowcount == 1
+            self.conn.commit()
+        if not reserved:
+            return False
+        if not thread.request_hedge():
+            with self.database_lock:
+                self.conn.execute("UPDATE transfert SET hedged = NULL WHERE transfert_id = ?", [thread.transfert_id])
+                self.conn.commit()
+            return False
+        host.thread_count += 1
+        self.total_threads += 1
+        thread.hedge_slot = True
+        return True
+
     # TODO: Make this do something.
     def adjust_hosts_max_thread_count(self):
         '''
@@ -465,6 +1358,153 @@ class Downloader:
         if not lm.is_logged_on():
             raise Exception('NOAUTH')
 
+    def credential_renewer(self):
+        '''
+        Routine which renews the credentials shortly before they expire, so
+        that transfers don't start failing with AUTH_FAIL. Spawned as a thread.
+        Internal.
+        '''
+        log.debug("Starting credential renewer...")
+        while self.running:
+            try:
+                remaining = credentials_expiry(credentials_path()) - time.time()
+            except (IOError, OpenSSL.crypto.Error) as e:
+                log.warning("Couldn't read credentials: " + str(e))
+                remaining = 0
+            wait = remaining - self.renew_credentials_before
+            if wait <= 0:
+                try:
+                    renew_credentials(self.username, self.password, self.auth_server, credentials_path())
+                    log.info("Renewed credentials")
+                    self.credentials_renewed.set()
+                    self.wake()
+                    wait = 60
+                except Exception as e:
+                    log.error("Couldn't renew credentials: " + str(e))
+                    wait = 60
+            self.check_credentials_now.wait(min(wait, 3600))
+            self.check_credentials_now.clear()
+        log.debug("Credential renewer exiting...")
+
+    def use_renewed_credentials(self):
+        '''
+        Makes new connections to each host use the renewed credentials, and
+        requeues transfers which failed with AUTH_FAIL since the credentials
+        were last renewed (or since this Downloader started), when they may
+        have failed because the credentials were expiring. Earlier failures,
+        such as files the user has no permission for, are left alone.
+        Downloads in progress keep their connections. Internal.
+        '''
+        for host in self.hosts.values():
+            size_connection_pools(host.session, host.max_thread_count)
+
+        since = self.last_credentials_renewal
+        self.last_credentials_renewal = time.time()
+        recent_auth_failures = "status = 'error' AND error_msg = 'AUTH_FAIL' AND CAST(end_date AS REAL) >= ?"
+        with self.database_lock:
+            failed = self.conn.execute("SELECT transfert_id, model, datanode FROM transfert " +
+                "WHERE " + recent_auth_failures, [since]).fetchall()
+            self.conn.execute("UPDATE transfert SET status = 'waiting', error_msg = NULL " +
+                "WHERE " + recent_auth_failures, [since])
+            self.conn.commit()
+        if len(failed) > 0:
+            log.info("Requeueing %d transfers which failed with AUTH_FAIL" % len(failed))
+        self.notify_waiting(failed)
+
+    def queue_new_transfers(self):
+        '''
+        Passes notices of waiting transfers from the metadata reader on to their hosts. Internal.
+        '''
+        while True:
+            try:
+                model, datanode, first_id, last_id = self.metadata_queue.get_nowait()
+            except Queue.Empty:
+                break
+            if(datanode not in self.hosts):
+                self.hosts[datanode] = Host(self.initial_threads_per_host, datanode, self.spawn_interval)
+            self.hosts[datanode].note_waiting(model, first_id, last_id)
+            if first_id is None:
+                self.rewind_past_released(self.hosts[datanode], model)
+
+    def rewind_past_released(self, host, model):
+        '''
+        Moves a host's cursor for a model back to the first transfer it passed
+        over which is waiting and unleased but not queued. fill_queue skips
+        transfers leased by other workers, and those workers may return them
+        to the 'waiting' state without their leases expiring (when stopping,
+        requeueing AUTH_FAIL transfers or restarting), which this worker
+        isn't told of. Internal.
+        :param host: The Host.
+        :param model: Name of the model.
+        '''
+        queued = set(item.transfert_id for item in host.download_queue)
+        with self.database_lock:
+            rows = self.conn.execute(
+                "SELECT transfert_id FROM transfert " +
+                "WHERE model = ? AND datanode = ? AND status = 'waiting' AND transfert_id <= ? " +
+                "AND (lease_owner IS NULL OR lease_expiry < ?) ORDER BY transfert_id",
+                [model, host.datanode, host.cursors[model], time.time()]).fetchall()
+        for (transfert_id,) in rows:
+            if transfert_id not in queued:
+                host.note_waiting(model, transfert_id)
+                break
+
+    def start_downloads(self, writer):
+        '''
+        Starts downloads from the host queues, as far as the thread limits
+        and each host's spawn interval allow. Internal.
+        :param writer: The MultiFileWriter downloads write through.
+        :rtype: The earliest time at which a host held back by its spawn
+            interval may start another download, or None if no host is.
+        '''
+        next_spawn_time = None
+        for hostname, host in self.hosts.items():
+            if len(host.download_queue) < self.pending_window / 2 and host.has_pending():
+                self.fill_queue(host)
+            while ((len(host.download_queue) != 0)
+                    and not self.draining
+                    and not host.paused
+                    and host.thread_count < host.max_thread_count
+                    and self.total_threads < self.max_total_threads):
+                now = time.time()
+                if now < host.next_spawn_time():
+                    if next_spawn_time is None or host.next_spawn_time() < next_spawn_time:
+                        next_spawn_time = host.next_spawn_time()
+                    break
+                item = host.download_queue.popleft()
+                claimed = self.claim(item.transfert_id, host)
+                if claimed is None:
+                    # Other workers are using all of this host's threads.
+                    host.download_queue.appendleft(item)
+                    break
+                elif not claimed:
+                    continue
+                self.download_threads[item.transfert_id] = DownloadThread(
+                    item.location,
+                    host.datanode,
+                    item.transfert_id,
+                    self.base_path + "/" + item.local_image,
+                    item.checksum,
+                    item.checksum_type,
+                    writer,
+                    self.event_queue,
+                    host.session,
+                    self.digests)
+
+                host.thread_count += 1
+                self.total_threads += 1
+                if len(host.download_queue) == 0 and host.has_pending():
+                    self.fill_queue(host)
+                self.scheduler_timer.count('spawns')
+                idle = host.slot_filled(time.time())
+                if idle is not None:
+                    self.scheduler_timer.add_time('slot_idle', idle)
+                    self.scheduler_timer.count('idle_slots_filled')
+            if host.paused or self.draining:
+                # Nothing will be started in slots freed meanwhile.
+                host.free_slot_times.clear()
+        return next_spawn_time
+
     def shutdown_now(self, signum, frame):
         '''
         Sets flags to specify that shutdown should happen immediately. Wired up as a signal handler.
@@ -490,6 +1530,10 @@ class Downloader:
             log.error("Couldn't log on using the provided credentials; exiting.")
             return
 
+        # Before the lease renewer starts, so that it doesn't keep alive
+        # leases taken by an earlier run with the same worker_id.
+        self.release_own_leases()
+
         # Write serializer thread
         writer = MultiFileWriter(self.max_queue_len)
 
@@ -498,43 +1542,52 @@ class Downloader:
         md_reader_thread.daemon = True
         md_reader_thread.start()
 
+        # Lease renewer thread; keeps our claims on running transfers alive.
+        lease_renewer_thread = threading.Thread(target=self.lease_renewer, name="LeaseRenewerThread")
+        lease_renewer_thread.daemon = True
+        lease_renewer_thread.start()
+
+        # Credential renewer thread; renews credentials before they expire.
+        credential_renewer_thread = threading.Thread(target=self.credential_renewer, name="CredentialRenewerThread")
+        credential_renewer_thread.daemon = True
+        credential_renewer_thread.start()
+
+        # Control socket thread; passes commands to this thread.
+        control_server = None
+        if self.control_socket is not None:
+            control_server = ControlServer(self.control_socket, self)
+            control_thread = threading.Thread(target=control_server.serve_forever, name="ControlThread")
+            control_thread.daemon = True
+            control_thread.start()
+
         # Then, for each model, queue up to n jobs.
         # The jobs communicate back to the parent thread here and statistics are gathered.
+        # Rather than polling, this thread waits on the event queue; the other
+        # threads feeding it post a WAKE event when they have something for it.
         while self.running:
             try:
-                # TODO: Split into function
-                while not self.metadata_queue.empty():
-                    item = self.metadata_queue.get(timeout=5)
-                    if(item['datanode'] not in self.hosts):
-                        self.hosts[item['datanode']] = Host(self.initial_threads_per_host, item['datanode'])
-                    self.hosts[item['datanode']].download_queue.append(item)
-
-                # Queue up threads to run from host queues
-                for hostname, host in self.hosts.items():
-                    while ((len(host.download_queue) != 0)
-                            and host.thread_count < host.max_thread_count
-                            and self.total_threads < self.max_total_threads):
-                        item = host.download_queue.popleft()
-                        self.download_threads[item['transfert_id']] = DownloadThread(
-                            item['location'],
-                            item['datanode'],
-                            item['transfert_id'],
-                            self.base_path + "/" + item['local_image'],
-                            item['checksum'],
-                            item['checksum_type'],
-                            writer,
-                            self.event_queue,
-                            host.session)
-
-                        host.thread_count += 1
-                        self.total_threads += 1
-                        self.handle_events()
-                        time.sleep(0.2)
-
+                self.queue_new_transfers()
+                next_spawn_time = self.start_downloads(writer)
                 self.adjust_hosts_max_thread_count()
-
-                self.handle_events()
-                time.sleep(0.1)
+                self.sample_progress()
+                self.check_stragglers()
+
+                if self.credentials_renewed.is_set():
+                    self.credentials_renewed.clear()
+                    self.use_renewed_credentials()
+                if self.draining and self.total_threads == 0:
+                    self.running = False
+
+                # Wait for something to happen, or until a host held back by
+                # its spawn interval may start another download. The wait is
+                # bounded so that shutdown signals are noticed.
+                timeout = 1.0
+                if not self.metadata_queue.empty():
+                    timeout = 0
+                elif next_spawn_time is not None:
+                    timeout = min(timeout, max(next_spawn_time - time.time(), 0))
+                self.handle_events(timeout)
+                self.handle_control()
             except KeyboardInterrupt:
                 self.shutdown_now(None, None)
 
@@ -547,7 +1600,7 @@ class Downloader:
                     dt.abort = True
                 self.conn.execute(
                     "UPDATE transfert " +
-                    "SET status='waiting' " +
+                    "SET status='waiting', lease_owner=NULL, lease_expiry=NULL " +
                     "WHERE transfert_id = ?", [dt.transfert_id])
             self.conn.commit()
             log.debug("Waiting 10s in the hopes threads die...")
@@ -560,24 +1613,358 @@ class Downloader:
         else:
             log.info("Waiting for remaining threads to finish...")
             while self.total_threads > 0:
-                self.handle_events()
-                time.sleep(0.2)
+                self.sample_progress()
+                self.handle_events(1.0)
+                self.handle_control()
             log.info("All download threads have shut down.")
             writer.write_and_quit()
+        for hostname, host in self.hosts.items():
+            log.info("Connections to %s: %d new, %d reused; slots idle %.1fs" % (
+                hostname, host.connection_stats()['new'], host.connection_stats()['reused'], host.slot_idle_time))
+        events = self.scheduler_timer.counts.get('events', 0)
+        if events > 0:
+            log.info("Scheduling latency: %.3fs mean over %d transfers" % (
+                self.scheduler_timer.times['event_latency'] / events, events))
+        if control_server is not None:
+            control_server.shutdown()
+            control_server.server_close()
+            os.unlink(self.control_socket)
         time.sleep(1)
         log.info("Writer thread has shut down. Have a nice day!")
         
-def make_session():
+def share_threads(caps, total):
+    '''
+    Shares threads among hosts as evenly as their individual limits allow. Internal.
+    :param caps: Dictionary of host to the most threads it can use.
+    :param total: Total number of threads to share.
+    :rtype: Dictionary of host to number of threads (possibly fractional).
+    '''
+    shares = {}
+    remaining = dict(caps)
+    while len(remaining) > 0 and total > 0:
+        share = float(total) / len(remaining)
+        capped = [ host for host, cap in remaining.items() if cap <= share ]
+        if len(capped) == 0:
+            for host in remaining:
+                shares[host] = share
+            break
+        for host in capped:
+            shares[host] = remaining.pop(host)
+            total -= shares[host]
+    return shares
+
+def plan_downloads(database_file, threads_per_host=3, max_total_threads=100):
+    '''
+    Projects how much each data node has to serve and how long it will take,
+    from the waiting transfers and the rates of transfers already completed.
+    Nothing is downloaded and no connections are opened.
+
+    Each host is assumed to download at its historical rate per thread, with
+    as many threads as it has waiting files up to threads_per_host; when
+    that adds up to more than max_total_threads, the threads are shared
+    evenly, and threads freed as hosts finish go to the hosts remaining.
+    Hosts without completed transfers are assumed to run at the mean rate of
+    the others.
+
+    File sizes are taken from fsize, falling back to the size recorded from
+    the catalog (size_xml_tag), which is where metadata_update stores them.
+
+    :param database_file: Sqlite3 database file listing the transfers.
+    :param threads_per_host: Thread limit per host.
+    :param max_total_threads: Thread limit over all hosts.
+    :rtype: List of dictionaries, one per host, with keys datanode, files,
+        bytes, unsized_files, rate (bytes per second per thread, or None),
+        rate_estimated, threads (at the start) and finish (seconds from the
+        start, or None), in order of projected finishing time, last first.
+    '''
+    conn = open_database(database_file)
+    size = "CAST(COALESCE(fsize, size_xml_tag) AS INTEGER)"
+    hosts = {}
+    for datanode, files, size_bytes, unsized_files in conn.execute(
+            "SELECT datanode, COUNT(*), SUM(" + size + "), COUNT(*) - COUNT(" + size + ") " +
+            "FROM transfert WHERE status = 'waiting' GROUP BY datanode"):
+        hosts[datanode] = { 'datanode': datanode, 'files': files, 'bytes': size_bytes or 0,
+                            'unsized_files': unsized_files, 'rate': None, 'rate_estimated': False,
+                            'threads': 0, 'finish': None }
+    for datanode, done_bytes, duration in conn.execute(
+            "SELECT datanode, SUM(" + size + "), SUM(duration) FROM transfert " +
+            "WHERE status = 'done' AND duration > 0 AND " + size + " > 0 GROUP BY datanode"):
+        if datanode in hosts:
+            hosts[datanode]['rate'] = float(done_bytes) / duration
+    conn.close()
+
+    known_rates = [ host['rate'] for host in hosts.values() if host['rate'] is not None ]
+    for host in hosts.values():
+        if host['rate'] is None and len(known_rates) > 0:
+            host['rate'] = sum(known_rates) / len(known_rates)
+            host['rate_estimated'] = True
+
+    # Step from one host finishing to the next, resharing threads each time.
+    remaining = dict((datanode, float(host['bytes'])) for datanode, host in hosts.items() if host['rate'] is not None)
+    elapsed = 0.0
+    first = True
+    while len(remaining) > 0:
+        threads = share_threads(dict((datanode, min(threads_per_host, hosts[datanode]['files'])) for datanode in remaining),
+                                max_total_threads)
+        if first:
+            for datanode, n in threads.items():
+                hosts[datanode]['threads'] = n
+            first = False
+        speeds = dict((datanode, threads.get(datanode, 0) * hosts[datanode]['rate']) for datanode in remaining)
+        if max(speeds.values()) <= 0:
+            break
+        step = min(remaining[datanode] / speed for datanode, speed in speeds.items() if speed > 0)
+        elapsed += step
+        for datanode, speed in speeds.items():
+            remaining[datanode] -= speed * step
+            if remaining[datanode] <= 1e-6 * max(hosts[datanode]['bytes'], 1):
+                hosts[datanode]['finish'] = elapsed
+                del remaining[datanode]
+
+    return sorted(hosts.values(), key=lambda host: (host['finish'] is not None, host['finish']), reverse=True)
+
+def make_session(pool_size=10):
     '''
     Creates a session, assuming the session certificate will be stored in $HOME/.esg/credentials.pem .
+
+    :param pool_size: The number of connections to keep open for reuse per
+        server; should be at least the number of threads using the session.
     '''
     sesh = requests.Session()
-    sesh.cert = os.environ['HOME'] + '/.esg/credentials.pem'
+    sesh.cert = credentials_path()
     sesh.max_redirects = 5
     sesh.stream = True
     sesh.verify = False
+    size_connection_pools(sesh, pool_size)
     return sesh
 
+def credentials_path():
+    '''
+    Returns the path of the session certificate, $HOME/.esg/credentials.pem .
+    '''
+    return os.environ['HOME'] + '/.esg/credentials.pem'
+
+def credentials_expiry(credentials_file):
+    '''
+    Reads the expiry time of the certificate in a credentials file.
+
+    :param credentials_file: Path to the PEM credentials file.
+    :rtype: Expiry time in seconds since the epoch.
+    '''
+    with open(credentials_file) as fh:
+        cert = OpenSSL.crypto.load_certificate(OpenSSL.crypto.FILETYPE_PEM, fh.read())
+    return calendar.timegm(time.strptime(cert.get_notAfter(), "%Y%m%d%H%M%SZ"))
+
+def renew_credentials(username, password, auth_server, credentials_file):
+    '''
+    Obtains new credentials from a MyProxy server and replaces the
+    credentials file with them. The file is replaced atomically, so
+    connections being made at the time see either the old credentials
+    or the new ones.
+
+    :param username: Username to use for authentication.
+    :param password: Password to use for authentication.
+    :param auth_server: MyProxy server to obtain credentials from.
+    :param credentials_file: Path to the PEM credentials file.
+    '''
+    client = MyProxyClient(hostname=auth_server,
+                           caCertDir=os.path.join(os.path.dirname(credentials_file), 'certificates'))
+    creds = client.logon(username, password, bootstrap=False, updateTrustRoots=True)
+    new_credentials_file = credentials_file + '.new'
+    with os.fdopen(os.open(new_credentials_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as fh:
+        for cred in creds:
+            fh.write(cred)
+    os.rename(new_credentials_file, credentials_file)
+
+# Time spent setting up connections by the current thread; see TimedHTTPAdapter.
+connection_setup = threading.local()
+
+def timed_connection(connection_class):
+    '''
+    Subclasses an urllib3 connection class so that the time spent
+    connecting (including any TLS handshake) is added to
+    connection_setup.time for the thread connecting. Internal.
+    :param connection_class: The urllib3 connection class.
+    :rtype: The subclass.
+    '''
+    class TimedConnection(connection_class):
+        def connect(self):
+            start = time.time()
+            try:
+                connection_class.connect(self)
+            finally:
+                connection_setup.time = getattr(connection_setup, 'time', 0.0) + time.time() - start
+    return TimedConnection
+
+class TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = timed_connection(HTTPConnection)
+
+class TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = timed_connection(HTTPSConnection)
+
+class TimedHTTPAdapter(HTTPAdapter):
+    '''
+    HTTP adapter whose connections record how long they take to set up,
+    so that connecting can be timed apart from waiting for the response.
+    '''
+    def init_poolmanager(self, *args, **kwargs):
+        HTTPAdapter.init_poolmanager(self, *args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': TimedHTTPConnectionPool, 'https': TimedHTTPSConnectionPool }
+
+def size_connection_pools(session, pool_size):
+    '''
+    Mounts HTTP adapters on a session which keep pool_size connections open
+    per server. The adapters replaced are closed, closing their idle
+    connections; connections held by responses in progress are unaffected,
+    and are closed when the responses release them. Their connection counts
+    are carried over to the new adapters.
+
+    :param session: The Requests session.
+    :param pool_size: The number of connections to keep open per server.
+    '''
+    for prefix in ['http://', 'https://']:
+        old_adapter = session.adapters.get(prefix)
+        adapter = TimedHTTPAdapter(pool_maxsize=pool_size)
+        session.mount(prefix, adapter)
+        if old_adapter is not None:
+            adapter.retired_counts = adapter_connection_counts(old_adapter)
+            old_adapter.close()
+
+def shutdown_response(res):
+    '''
+    Shuts down the connection a streamed response is being read over, so
+    that a thread blocked reading it wakes up.
+    :param res: The Response, or None.
+    '''
+    try:
+        res.raw._connection.sock.shutdown(socket.SHUT_RDWR)
+    except Exception:
+        pass
+
+def session_connection_stats(session):
+    '''
+    Counts the connections a session has opened, and the requests which
+    reused an already open connection (sparing a TCP and TLS handshake).
+
+    :param session: The Requests session.
+    :rtype: Dictionary with the number of 'new' and 'reused' connections.
+    '''
+    new = requests_made = 0
+    for adapter in session.adapters.values():
+        adapter_new, adapter_requests = adapter_connection_counts(adapter)
+        new += adapter_new
+        requests_made += adapter_requests
+    return { 'new': new, 'reused': requests_made - new }
+
+def adapter_connection_counts(adapter):
+    '''
+    Counts the connections an HTTP adapter has opened and the requests made
+    through it, including those of the adapters it replaced. Internal.
+
+    :param adapter: The HTTP adapter.
+    :rtype: Tuple of the number of connections and the number of requests.
+    '''
+    new, requests_made = getattr(adapter, 'retired_counts', (0, 0))
+    pools = adapter.poolmanager.pools
+    for key in pools.keys():
+        pool = pools.get(key)
+        if pool is not None:
+            new += pool.num_connections
+            requests_made += pool.num_requests
+    return new, requests_made
+
+def parse_time(timestamp, end=False):
+    '''
+    Normalizes a CMIP5 filename timestamp (YYYY, YYYYMM, YYYYMMDD, YYYYMMDDhh
+    or YYYYMMDDhhmm[ss]) to an integer of the form YYYYMMDDhhmm, so that
+    timestamps of different precisions can be compared.
+
+    :param timestamp: The timestamp.
+    :param end: Whether this is the end of a range; if so, missing parts are
+        filled in with their latest values rather than their earliest.
+    :rtype: Integer, or None if the timestamp can't be parsed.
+    '''
+    if timestamp is None or not timestamp.isdigit() or len(timestamp) not in (4, 6, 8, 10, 12, 14):
+        return None
+    padding = "12312359" if end else "01010000"
+    timestamp = timestamp[:12]
+    return int(timestamp + padding[len(timestamp) - 4:])
+
+def parse_time_range(filename):
+    '''
+    Parses the time range out of a CMIP5 filename (eg
+    pr_day_CCSM4_rcp45_r1i1p1_20060101-20101231.nc).
+
+    :param filename: The filename.
+    :rtype: Tuple of start and end times as returned by parse_time; both
+        None if the file has no time range.
+    '''
+    fields = split_filename(filename)
+    return (parse_time(fields['tstart']), parse_time(fields['tend'], end=True))
+
+def backfill_time_ranges(conn):
+    '''
+    Fills in the experiment, ensemble, time frequency and time range of
+    transfers recorded before these were harvested, from their local_image.
+
+    :param conn: The sqlite3 connection to the database.
+    '''
+    rows = conn.execute("SELECT transfert_id, local_image FROM transfert WHERE time_start IS NULL").fetchall()
+    for transfert_id, local_image in rows:
+        path_parts = (local_image or '').split('/')
+        if len(path_parts) < 12:
+            continue
+        time_start, time_end = parse_time_range(path_parts[-1])
+        conn.execute("UPDATE transfert SET experiment = ?, ensemble = ?, time_frequency = ?, " +
+                     "time_start = ?, time_end = ? WHERE transfert_id = ?",
+                     [path_parts[-8], path_parts[-4], path_parts[-7], time_start, time_end, transfert_id])
+    log.debug("Filled in time ranges for %d transfers" % len(rows))
+
+def upgrade_schema(conn):
+    '''
+    Brings the schema of an existing database up to date by adding any
+    columns, tables, views and indices added since it was created.
+
+    :param conn: The sqlite3 connection to the database.
+    '''
+    added_columns = []
+    for table, column, column_type in schema_columns:
+        existing_columns = [ row[1] for row in conn.execute("PRAGMA table_info(%s)" % table) ]
+        if column not in existing_columns:
+            log.debug("Adding column %s to table %s" % (column, table))
+            conn.execute("ALTER TABLE %s ADD COLUMN %s %s" % (table, column, column_type))
+            added_columns.append(column)
+    if 'time_start' in added_columns:
+        backfill_time_ranges(conn)
+    if 'datanode' in added_columns:
+        # Transfers recorded before then were all taken from their model's data node.
+        conn.execute("UPDATE transfert SET datanode = (SELECT datanode FROM model WHERE model.name = transfert.model)")
+    for statement in schema_statements:
+        conn.execute(statement)
+    conn.commit()
+
+def open_database(database_file, timeout=5.0):
+    '''
+    Opens the given database, creating the schema if the database is new
+    and upgrading it if it is out of date.
+
+    :param database_file: The sqlite3 database file.
+    :param timeout: Time in seconds to wait for other connections to release locks.
+    :rtype: An sqlite3 connection.
+    '''
+    db_exists = os.path.isfile(database_file)
+    conn = sqlite3.connect(database_file, timeout=timeout)
+
+    ## Stick the schema in the database if it is absent.
+    if not db_exists:
+        schema_text = resource_stream('esgf_download', '/data/schema.sql')
+        for line in schema_text:
+            conn.execute(line)
+        conn.commit()
+    upgrade_schema(conn)
+    return conn
+
 def unlist(x):
     '''
     Takes an object, returns the 1st element if it is a list, thereby removing list wrappers from singletons.
@@ -601,39 +1988,202 @@ def get_property_dict(xml_tree,
     '''
     return {x.get('name'):x.get('value') for x in xml_tree.xpath(xpath_text, namespaces=namespaces)}
 
+class NodeHealth:
+    '''
+    Keeps track of how data nodes respond to catalog requests, so that each
+    dataset's catalog can be fetched from the copy on the healthiest node.
+    '''
+    def __init__(self):
+        self.failures = {}
+        self.latencies = {}
+
+    def succeeded(self, data_node, latency):
+        '''
+        Records a successful request.
+        :param data_node: The data node.
+        :param latency: Time in seconds the request took.
+        '''
+        previous = self.latencies.get(data_node)
+        self.latencies[data_node] = latency if previous is None else 0.8 * previous + 0.2 * latency
+
+    def failed(self, data_node):
+        '''
+        Records a failed request.
+        :param data_node: The data node.
+        '''
+        self.failures[data_node] = self.failures.get(data_node, 0) + 1
+
+    def rank(self, records):
+        '''
+        Orders copies of a dataset from most to least promising: fewest
+        failures first, then lowest latency. Nodes not yet tried come before
+        nodes of known latency, so that every node gets tried; ties go to
+        the original copy.
+        :param records: JSON search records for the copies.
+        :rtype: List of the records.
+        '''
+        return sorted(records, key=lambda record: (
+            self.failures.get(record['data_node'], 0),
+            self.latencies.get(record['data_node'], 0.0),
+            bool(record.get('replica')),
+            record['data_node']))
+
+def replica_group_key(record):
+    '''
+    Returns the key under which copies of the same dataset version are
+    grouped: the master id and version, or the record's own id if it has no
+    master id.
+    :param record: JSON search record for a dataset.
+    :rtype: Tuple of master id and version.
+    '''
+    if record.get('master_id') is None:
+        return (unlist(record['id']), None)
+    return (unlist(record['master_id']), unicode(unlist(record.get('version'))))
+
+def search_datasets(search_host, constraints, search_cache=None, shard_facet=None, replica=None):
+    '''
+    Searches for datasets, optionally through a cache of search results.
+
+    If shard_facet names a constraint, a separate search is made for each of
+    its values and the results combined, so that each value's results are
+    cached separately; a later search with more values of that facet only
+    searches for the values not already cached.
+
+    :param search_host: The search host to use.
+    :param constraints: Dictionary of constraints for the search.
+    :param search_cache: Optional SearchCache to read results from and store them in.
+    :param shard_facet: Optional name of a constraint to split the search by.
+    :param replica: True to find only replicas, False to find only
+        original copies, or None to find every copy.
+    :rtype: Iterator over the datasets' JSON records.
+    '''
+    constraints = normalize_constraints(constraints)
+    if shard_facet is None or shard_facet not in constraints:
+        shards = [ constraints ]
+    else:
+        shards = [ dict(constraints, **{ shard_facet: [value] }) for value in constraints[shard_facet] ]
+
+    seen = set()
+    for shard in shards:
+        # The key includes the replica setting, which isn't passed as a constraint.
+        key = dict(shard, replica=replica)
+        records = None if search_cache is None else search_cache.get(search_host, key)
+        if records is None:
+            search_conn = SearchConnection(search_host, distrib=True)
+            ctx = pyesgf.search.SearchContext(search_conn, shard, replica=replica, search_type=pyesgf.search.TYPE_DATASET)
+            records = (result.json for result in ctx.search())
+            if search_cache is not None:
+                records = search_cache.store(search_host, key, records)
+        for record in records:
+            # A dataset may turn up in several shards.
+            if len(shards) > 1:
+                if record['id'] in seen:
+                    continue
+                seen.add(record['id'])
+            yield record
+
+def start_harvest(conn, search_host, constraints):
+    '''
+    Finds the harvest with the given search host and constraints, recording
+    a new one if there is none, and marks it unfinished.
+    :param conn: sqlite3 connection to the database.
+    :param search_host: The search host.
+    :param constraints: The constraints for the search.
+    :rtype: Tuple of the harvest's id and a dictionary mapping the
+        (master id, version) keys of the dataset versions it has already
+        processed to tuples of status ('done' or 'failed') and time processed.
+    '''
+    constraints_json = json.dumps(normalize_constraints(constraints), sort_keys=True)
+    row = conn.execute("SELECT harvest_id FROM harvest WHERE search_host = ? AND constraints = ?",
+                       [search_host, constraints_json]).fetchone()
+    if row is None:
+        harvest_id = conn.execute("INSERT INTO harvest(search_host, constraints, started) VALUES (?, ?, ?)",
+                                  [search_host, constraints_json, time.time()]).lastrowid
+    else:
+        harvest_id = row[0]
+        conn.execute("UPDATE harvest SET finished = NULL WHERE harvest_id = ?", [harvest_id])
+    conn.commit()
+    # Versions of datasets without a master id are stored as '', as NULLs are distinct in keys.
+    processed = dict(((master_id, version if version != '' else None), (status, processed))
+                     for master_id, version, status, processed in conn.execute(
+                         "SELECT master_id, version, status, processed FROM harvest_dataset WHERE harvest_id = ?",
+                         [harvest_id]))
+    return harvest_id, processed
+
+def record_harvested(conn, harvest_id, key, status, error_msg=None):
+    '''
+    Records that a harvest has processed, or failed to process, a dataset version.
+    :param conn: sqlite3 connection to the database.
+    :param harvest_id: The harvest's id.
+    :param key: The (master id, version) key of the dataset version.
+    :param status: 'done' or 'failed'.
+    :param error_msg: Why the dataset version failed, if it did.
+    '''
+    master_id, version = key
+    conn.execute("INSERT OR REPLACE INTO harvest_dataset " +
+                 "(harvest_id, master_id, version, status, error_msg, processed) VALUES (?, ?, ?, ?, ?, ?)",
+                 [harvest_id, master_id, '' if version is None else version, status, error_msg, time.time()])
+    conn.commit()
+
 # Constraints can be lists of values, but must be named.
 # TODO: Fetch multiple XML files at once.
 # Try using select()?
 def metadata_update(database_file,
                     search_host="http://pcmdi.llnl.gov/esg-search",
+                    timer=None,
+                    search_cache=None,
+                    shard_facet=None,
+                    refresh_older_than=None,
                     **constraints):
     '''
     Queries the ESGF server for a set of datasets, queries each THREDDS
     server for metadata for each data set (the list of files), and records
     information about datasets and data files in the given database file.
 
+    Copies of a dataset (the original and its replicas, which share a master
+    id and version) are collapsed before any catalog is fetched: only one
+    copy's catalog is fetched, from the data node which has responded best
+    so far. Every copy is recorded in the dataset_replica table. As a
+    model's datasets may be fetched from different data nodes, each
+    transfer records the data node its file comes from (transfert.datanode),
+    which is what downloads are grouped and limited by; model.datanode is
+    just the data node of the first of the model's datasets harvested.
+
+    Progress is saved in the database as each dataset version is processed
+    (in the harvest and harvest_dataset tables), so running the same
+    harvest (same search host and constraints) again resumes it: dataset
+    versions already processed are skipped, and those which failed are
+    retried.
+
     :param database_file: The database file to store information in.
     :param search_host: The search host to use.
+    :param timer: Optional PhaseTimer which accumulates time spent in the
+        'search', 'fetch', 'parse' and 'insert' phases, and counts 'datasets'
+        and 'files' inserted, 'replicas_skipped', and 'datasets_skipped'
+        and 'datasets_failed'.
+    :param search_cache: Optional SearchCache to reuse search results from.
+    :param shard_facet: Optional name of a constraint to split the search by,
+        so that its values are searched for (and cached) separately. See
+        search_datasets.
+    :param refresh_older_than: Optional time in seconds; dataset versions
+        this harvest processed longer ago than this are processed again.
     :param **constraints: The constraints for the search.
     '''
+    if timer is None:
+        timer = PhaseTimer()
 
-    db_exists = os.path.isfile(database_file)
     log.info('Using database %s' % database_file)
-
-    conn = sqlite3.connect(database_file)
-
-    ## Stick the schema in the database if it is absent.
-    if not db_exists:
-        schema_text = resource_stream('esgf_download', '/data/schema.sql')
-        for line in schema_text:
-            conn.execute(line)
-        conn.commit()
-
+    conn = open_database(database_file)
     curse = conn.cursor()
+    harvest_id, processed = start_harvest(conn, search_host, constraints)
+    if len(processed) > 0:
+        log.info("Resuming harvest %d, which has processed %d dataset versions" % (harvest_id, len(processed)))
 
-    search_conn = SearchConnection(search_host, distrib=True)
     ## Need to turn on WAL: http://www.sqlite.org/draft/wal.html
-    ctx = pyesgf.search.SearchContext(search_conn, constraints, replica=True, search_type=pyesgf.search.TYPE_DATASET)
+    # Every copy is searched for, so that the copies of each dataset can be
+    # collapsed and its catalog fetched from only one of them.
+    datasets = search_datasets(search_host, constraints, search_cache, shard_facet, replica=None)
+    health = NodeHealth()
 
     field_map_model = {
         'data_node': 'datanode',
@@ -652,7 +2202,14 @@ def metadata_update(database_file,
         'product': 'local_product',
         'local_image': 'local_image',
         'status': 'status',
-        'location': 'location'}
+        'location': 'location',
+        'experiment': 'experiment',
+        'ensemble': 'ensemble',
+        'time_frequency': 'time_frequency',
+        'time_start': 'time_start',
+        'time_end': 'time_end',
+        'master_id': 'master_id',
+        'data_node': 'datanode'}
 
     model_fetch_query = "SELECT name from model where name = ?"
     model_insert_query = "INSERT INTO model({}) VALUES({})".format(
@@ -660,6 +2217,8 @@ def metadata_update(database_file,
         ",".join(["?"] * len(field_map_model))
     )
     transfert_fetch_query = "SELECT transfert_id from transfert where tracking_id = ?"
+    replica_insert_query = ("INSERT OR REPLACE INTO dataset_replica " +
+        "(master_id, version, data_node, catalog_url, replica, harvested) VALUES (?, ?, ?, ?, ?, ?)")
     transfert_insert_query = "INSERT INTO transfert({}) VALUES({})".format(
         ",".join(field_map_transfert.values()),
         ",".join(["?"] * len(field_map_transfert))
@@ -689,45 +2248,97 @@ def metadata_update(database_file,
         "ud:service[@name='HTTPServer' or @serviceType='HTTPServer']", namespaces=ns)
     get_variables = etree.XPath("ud:variables/ud:variable", namespaces=ns)
 
-    ds = ctx.search()
-    for ds0 in ds:
+    # Group the copies of each dataset version before fetching anything.
+    groups = OrderedDict()
+    while True:
+        # Results are paged in as they are read, so reading counts as searching.
+        with timer.phase('search'):
+            record = next(datasets, None)
+        if record is None:
+            break
+        groups.setdefault(replica_group_key(record), []).append(record)
+
+    refresh_before = None if refresh_older_than is None else time.time() - refresh_older_than
+    for key, copies in groups.items():
+        master_id, dataset_version = key
+        status, processed_time = processed.get(key, (None, None))
+        if status == 'done' and (refresh_before is None or processed_time >= refresh_before):
+            timer.count('datasets_skipped')
+            continue
         ## TODO: REFINE THIS: Parse the date coded version out of the URL and compare it to the most recent version in the database. If it's newer, index it. Otherwise, don't. This will save a lot of time.
-        try:
-            xml_query = get_request(requests, unlist(ds0.json['url']))
-        except Exception as e:
-            log.warning('Error fetching metadata from ' + unlist(ds0.json['url']) + ': ' + str(e))
+        # Fetch the catalog from the most promising copy, falling back on the others.
+        ds0 = None
+        fetch_error = None
+        for candidate in health.rank(copies):
+            fetch_start = time.time()
+            try:
+                with timer.phase('fetch'):
+                    xml_query = get_request(requests, unlist(candidate['url']))
+            except Exception as e:
+                health.failed(candidate['data_node'])
+                fetch_error = str(e)
+                log.warning('Error fetching metadata from ' + unlist(candidate['url']) + ': ' + str(e))
+                continue
+            health.succeeded(candidate['data_node'], time.time() - fetch_start)
+            ds0 = candidate
+            break
+        if ds0 is None:
+            record_harvested(conn, harvest_id, key, 'failed', 'FETCH_FAILED: ' + fetch_error)
+            timer.count('datasets_failed')
             continue
+        timer.count('replicas_skipped', len(copies) - 1)
+
+        with timer.phase('insert'):
+            conn.executemany(replica_insert_query, [
+                (master_id, dataset_version, copy['data_node'], unlist(copy['url']),
+                 bool(copy.get('replica')), copy is ds0) for copy in copies ])
+            conn.commit()
 
-        tree = etree.XML(xml_query.content)
+        try:
+            with timer.phase('parse'):
+                tree = etree.XML(xml_query.content)
+                dataset_metadata = get_property_dict(get_master_dataset(tree)[0])
+        except (etree.XMLSyntaxError, IndexError) as e:
+            log.warning("Could not parse catalog " + unlist(ds0['url']) + ": " + str(e))
+            record_harvested(conn, harvest_id, key, 'failed', 'BAD_CATALOG: ' + str(e))
+            timer.count('datasets_failed')
+            continue
         log.debug("Fetched metadata from thredds server...")
+        timer.count('datasets')
 
-        dataset_metadata = get_property_dict(get_master_dataset(tree)[0])
-        httpserver = get_thredds_server_base(tree)
-        if len(httpserver) == 0:
-            httpserver = get_thredds_server_base_alt(tree)
+        with timer.phase('parse'):
+            httpserver = get_thredds_server_base(tree)
             if len(httpserver) == 0:
-                log.warning("Could not find a base for the Thredds HTTP server; not considering this data.")
-                continue
+                httpserver = get_thredds_server_base_alt(tree)
+        if len(httpserver) == 0:
+            log.warning("Could not find a base for the Thredds HTTP server; not considering this data.")
+            record_harvested(conn, harvest_id, key, 'failed', 'NO_HTTP_SERVER')
+            timer.count('datasets_failed')
+            continue
 
         thredds_server_base = httpserver[0].get('base')
         thredds_httpserver_service_name = httpserver[0].get('name')
 
         # Check whether model in table; if not, add it.
-        curse.execute(model_fetch_query, [unlist(ds0.json["model"])])
-        num_results = len(curse.fetchall())
-        if(num_results == 0):
-            conn.execute(model_insert_query, [unlist(ds0.json[x]) for x in field_map_model.keys()])
-            conn.commit()
+        with timer.phase('insert'):
+            curse.execute(model_fetch_query, [unlist(ds0["model"])])
+            num_results = len(curse.fetchall())
+            if(num_results == 0):
+                conn.execute(model_insert_query, [unlist(ds0[x]) for x in field_map_model.keys()])
+                conn.commit()
 
         ## Winnow away the variables we don't want and loop over the remainder
-        filter_elements = etree.XPath("/ud:catalog/ud:dataset/ud:dataset[ud:serviceName='" +
-            thredds_httpserver_service_name + "']/ud:variables/ud:variable[" +
-            " or ".join(["@name='%s'" % var for var in constraints['variable'] ]) +
-            "]/../..", namespaces=ns)
-        matches = filter_elements(tree)
+        with timer.phase('parse'):
+            filter_elements = etree.XPath("/ud:catalog/ud:dataset/ud:dataset[ud:serviceName='" +
+                thredds_httpserver_service_name + "']/ud:variables/ud:variable[" +
+                " or ".join(["@name='%s'" % var for var in constraints['variable'] ]) +
+                "]/../..", namespaces=ns)
+            matches = filter_elements(tree)
         for ds_file in matches:
+            parse_start = time.time()
             file_metadata = get_property_dict(ds_file)
-            metadata = dict(ds0.json, **file_metadata)
+            metadata = dict(ds0, **file_metadata)
+            metadata.setdefault('master_id', None)
 
             # Get details that shouild be included in metadata and put them in there.
             metadata['version'] = datetime.strptime(metadata["mod_time"], "%Y-%m-%d %H:%M:%S").strftime("v%Y%m%d")
@@ -738,18 +2349,29 @@ def metadata_update(database_file,
             metadata['local_image'] = "/".join([ unlist(metadata[x]) for x in output_path_json_bits ])
             metadata['location'] = "http://" + metadata['data_node'] + thredds_server_base + ds_file.get('urlPath')
             metadata['status'] = 'waiting'
-
-            curse.execute(transfert_fetch_query, [unlist(metadata['tracking_id'])])
-            num_results = len(curse.fetchall())
-            if(num_results == 0):
-                # Check that all the bits that should be there, are.
-                missing_keys = field_map_transfert.viewkeys() - metadata.viewkeys()
-                if len(missing_keys) > 0:
-                    log.warning("Error: dataset object " +
-                        metadata['location'] +
-                        " will be omitted as it is missing the following keys: " +
-                        ",".join(missing_keys))
-                    continue
-                conn.execute(transfert_insert_query, [unlist(metadata[x]) for x in field_map_transfert.keys()])
-                conn.commit()
-                log.debug("Inserted a transfer...")
+            metadata['time_start'], metadata['time_end'] = parse_time_range(metadata['filename'])
+            timer.add_time('parse', time.time() - parse_start)
+
+            with timer.phase('insert'):
+                curse.execute(transfert_fetch_query, [unlist(metadata['tracking_id'])])
+                num_results = len(curse.fetchall())
+                if(num_results == 0):
+                    # Check that all the bits that should be there, are.
+                    missing_keys = field_map_transfert.viewkeys() - metadata.viewkeys()
+                    if len(missing_keys) > 0:
+                        log.warning("Error: dataset object " +
+                            metadata['location'] +
+                            " will be omitted as it is missing the following keys: " +
+                            ",".join(missing_keys))
+                        continue
+                    conn.execute(transfert_insert_query, [unlist(metadata[x]) for x in field_map_transfert.keys()])
+                    conn.commit()
+                    timer.count('files')
+                    log.debug("Inserted a transfer...")
+        record_harvested(conn, harvest_id, key, 'done')
+
+    conn.execute("UPDATE harvest SET finished = ? WHERE harvest_id = ?", [time.time(), harvest_id])
+    conn.commit()
+    log.info("Harvest %d finished: %d dataset versions processed, %d skipped as already processed, %d failed" % (
+        harvest_id, timer.counts.get('datasets', 0), timer.counts.get('datasets_skipped', 0),
+        timer.counts.get('datasets_failed', 0)))
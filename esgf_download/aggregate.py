@@ -0,0 +1,233 @@
+'''
+Aggregation of the time-chunked files of each downloaded dataset into one
+file per dataset, as ``aggregate.data`` in ``scripts/aggregate_and_rename.r``
+does with ncrcat, but planned from the time ranges recorded in the
+transfert table rather than by opening every file.
+
+Files are concatenated along the record (time) dimension by streaming:
+the output is the first file's header and fixed-size variables, with its
+record count patched to the total, followed by the records of each file in
+turn, copied a slab at a time. Memory use is bounded by the slab size
+however large the files are. Only classic format (CDF-1, CDF-2 and CDF-5)
+files whose record variables are laid out identically, with the same
+units, can be concatenated this way; datasets of other files are skipped.
+
+Independent datasets are aggregated in parallel in a pool of processes.
+'''
+
+import os
+import struct
+import logging
+import itertools
+import multiprocessing
+
+from esgf_download.symlinks import split_filename
+from esgf_download.netcdf_header import read_header
+
+log = logging.getLogger(__name__)
+
+# Columns identifying the files of one version of a dataset (as time_range_group).
+dataset_columns = ['model', 'experiment', 'ensemble', 'time_frequency', 'variable', 'version_xml_tag']
+
+class IncompatibleFiles(Exception):
+    '''
+    Raised when files can't be concatenated along their record dimension.
+    '''
+    pass
+
+def choose_files(files):
+    '''
+    Chooses the files of one dataset to concatenate, as get.data.aggs and
+    in.between do: files whose time range lies within another file's (the
+    pieces of an earlier aggregate) are left out.
+
+    :param files: List of (local_image, time_start, time_end) tuples.
+    :rtype: List of the chosen tuples in time order, or None if the
+        remaining files overlap and so can't be concatenated.
+    '''
+    files = sorted(files, key=lambda f: (f[1], -f[2]))
+    chosen = []
+    for f in files:
+        if len(chosen) > 0 and chosen[-1][1] <= f[1] and f[2] <= chosen[-1][2]:
+            continue
+        if len(chosen) > 0 and f[1] <= chosen[-1][2]:
+            return None
+        chosen.append(f)
+    return chosen
+
+def aggregate_name(local_images):
+    '''
+    Names the aggregate of files, as aggregate.data does:
+    <var>_<tres>_<model>_<emissions>_<run>_<first start>-<last end>.nc,
+    in the first file's directory.
+    :param local_images: Paths of the files, in time order.
+    :rtype: Path of the aggregate.
+    '''
+    first = split_filename(os.path.basename(local_images[0]))
+    last = split_filename(os.path.basename(local_images[-1]))
+    name = "_".join([ first[x] for x in ['var', 'tres', 'model', 'emissions', 'run'] ] +
+                    [ first['tstart'] + '-' + last['tend'] ]) + '.nc'
+    return os.path.join(os.path.dirname(local_images[0]), name)
+
+def plan_aggregation(conn):
+    '''
+    Works out which datasets need aggregating, from the time ranges of
+    their downloaded files.
+
+    :param conn: sqlite3 connection to the database.
+    :rtype: List of (aggregate local_image, list of input local_images)
+        tuples, one per dataset with more than one file to concatenate.
+    '''
+    plan = []
+    rows = conn.execute(
+        "SELECT " + ",".join(dataset_columns) + ", local_image, time_start, time_end FROM transfert " +
+        "WHERE status = 'done' AND time_start IS NOT NULL " +
+        "ORDER BY " + ",".join(dataset_columns) + ", time_start")
+    for dataset, files in itertools.groupby(rows, lambda row: row[:len(dataset_columns)]):
+        files = [ row[len(dataset_columns):] for row in files ]
+        chosen = choose_files(files)
+        if chosen is None:
+            log.warning("Files of dataset %s overlap in time; not aggregating it" % "_".join(map(unicode, dataset)))
+            continue
+        if len(chosen) < 2:
+            continue
+        local_images = [ f[0] for f in chosen ]
+        plan.append((aggregate_name(local_images), local_images))
+    return plan
+
+def record_layout(header):
+    '''
+    Describes what must match for files' records to be concatenated. Internal.
+    :param header: NetCDFHeader of a file.
+    :rtype: Tuple which is equal for compatible files.
+    '''
+    return (header.version, header.record_dimension,
+            tuple([ (name, length) for name, length in header.dimensions if name != header.record_dimension ]),
+            tuple([ (var.name, tuple(var.dimensions), var.nc_type, var.vsize, var.attributes.get('units'))
+                    for var in header.record_variables() ]))
+
+def copy_bytes(f, out, length, buffer_size):
+    '''
+    Copies bytes from one file to another a slab at a time. Internal.
+    :param f: File to copy from, positioned at the first byte to copy.
+    :param out: File to copy to.
+    :param length: Number of bytes to copy.
+    :param buffer_size: Most bytes copied at a time.
+    :raises ValueError: If the file to copy from ends too soon.
+    '''
+    while length > 0:
+        chunk = f.read(min(buffer_size, length))
+        if chunk == '':
+            raise ValueError(f.name + " is truncated")
+        out.write(chunk)
+        length -= len(chunk)
+
+def concatenate_records(inputs, output, buffer_size=4 * 1024 * 1024):
+    '''
+    Concatenates classic format NetCDF files along their record dimension
+    into a new file, streaming the records a slab at a time. Global
+    attributes and fixed-size variables are taken from the first file.
+    The output is written under a temporary name and renamed when complete.
+
+    :param inputs: Paths of the files, in order.
+    :param output: Path of the file to write.
+    :param buffer_size: Most bytes copied at a time.
+    :raises IncompatibleFiles: If the files' record variables differ.
+    :raises ValueError: If a file isn't a classic format NetCDF file.
+    :rtype: Number of records written.
+    '''
+    headers = []
+    for path in inputs:
+        with open(path, 'rb') as f:
+            header = read_header(f)
+        if header.record_begin() is None:
+            raise IncompatibleFiles(path + " has no record variables")
+        if header.numrecs is None:
+            # Still being written when it was closed; count the complete records.
+            header.numrecs = (os.path.getsize(path) - header.record_begin()) // header.record_size()
+        if len(headers) > 0 and record_layout(header) != record_layout(headers[0]):
+            raise IncompatibleFiles(path + " has different record variables than " + inputs[0])
+        headers.append(header)
+    numrecs = sum([ h.numrecs for h in headers ])
+    numrecs_format = headers[0].numrecs_format()
+    if numrecs >= 2 ** (8 * struct.calcsize(numrecs_format)) - 1:
+        raise IncompatibleFiles("too many records for the format of " + inputs[0])
+
+    temp_output = "%s.%d.tmp" % (output, os.getpid())
+    complete = False
+    try:
+        with open(temp_output, 'wb') as out:
+            for path, header in zip(inputs, headers):
+                with open(path, 'rb') as f:
+                    if header is headers[0]:
+                        # The header and fixed-size variables, with the new record count.
+                        out.write(f.read(4))
+                        out.write(struct.pack(numrecs_format, numrecs))
+                        f.seek(4 + struct.calcsize(numrecs_format))
+                        copy_bytes(f, out, header.record_begin() - f.tell(), buffer_size)
+                    f.seek(header.record_begin())
+                    copy_bytes(f, out, header.numrecs * header.record_size(), buffer_size)
+        os.rename(temp_output, output)
+        complete = True
+    finally:
+        if not complete and os.path.exists(temp_output):
+            os.unlink(temp_output)
+    return numrecs
+
+def aggregate_dataset(task):
+    '''
+    Aggregates one dataset, unless its aggregate already exists. Runs in a
+    pool process. Internal.
+    :param task: Tuple of the base path, the aggregate's local_image, the
+        inputs' local_images and the buffer size.
+    :rtype: Tuple of the aggregate's local_image, the number of records
+        written (None if it already existed) and an error message (None if
+        there was no error).
+    '''
+    base_path, output, inputs, buffer_size = task
+    output_path = os.path.join(base_path, output)
+    if os.path.exists(output_path):
+        return output, None, None
+    try:
+        numrecs = concatenate_records([ os.path.join(base_path, i) for i in inputs ], output_path, buffer_size)
+    except (IncompatibleFiles, ValueError, IOError, OSError) as e:
+        return output, None, str(e)
+    return output, numrecs, None
+
+def aggregate_downloads(conn, base_path, processes=None, buffer_size=4 * 1024 * 1024, dry_run=False):
+    '''
+    Aggregates the downloaded files of each dataset with more than one,
+    several datasets at a time.
+
+    :param conn: sqlite3 connection to the database.
+    :param base_path: Base path the files were downloaded to.
+    :param processes: Number of processes to aggregate in; defaults to the
+        number of CPUs.
+    :param buffer_size: Most bytes each process copies at a time.
+    :param dry_run: Only log what would be aggregated.
+    :rtype: Tuple of the number of aggregates written and the number of
+        datasets which couldn't be aggregated.
+    '''
+    plan = plan_aggregation(conn)
+    if dry_run:
+        for output, inputs in plan:
+            log.info("Would aggregate %s into %s" % (", ".join(inputs), output))
+        return 0, 0
+    written = failed = 0
+    pool = multiprocessing.Pool(processes)
+    try:
+        tasks = [ (base_path, output, inputs, buffer_size) for output, inputs in plan ]
+        for output, numrecs, error in pool.imap_unordered(aggregate_dataset, tasks):
+            if error is not None:
+                log.warning("Couldn't aggregate %s: %s" % (output, error))
+                failed += 1
+            elif numrecs is not None:
+                log.info("Wrote %s (%d records)" % (output, numrecs))
+                written += 1
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    return written, failed
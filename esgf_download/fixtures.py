@@ -0,0 +1,287 @@
+'''
+Offline fixtures for exercising metadata harvesting without touching the
+federation. Generates ESGF search results and THREDDS catalogs which look
+like the real thing, and serves them from a local stand-in server which
+speaks enough of the esg-search and THREDDS protocols for
+:func:`esgf_download.metadata_update` to run against it.
+'''
+
+import os
+import json
+import random
+import hashlib
+import logging
+import threading
+import urlparse
+import BaseHTTPServer
+import SocketServer
+from datetime import datetime, timedelta
+from xml.sax.saxutils import quoteattr
+
+log = logging.getLogger(__name__)
+
+THREDDS_NS = 'http://www.unidata.ucar.edu/namespaces/thredds/InvCatalog/v1.0'
+LAYOUTS = ['fileService', 'HTTPServer']
+
+# Institute, model pairs in the style of CMIP5.
+MODELS = [
+    ('CCCma', 'CanESM2'),
+    ('NCAR', 'CCSM4'),
+    ('MPI-M', 'MPI-ESM-LR'),
+    ('MOHC', 'HadGEM2-ES'),
+    ('IPSL', 'IPSL-CM5A-LR'),
+    ('NOAA-GFDL', 'GFDL-CM3'),
+    ('ICHEC', 'EC-EARTH'),
+    ('CSIRO-BOM', 'ACCESS1-0'),
+    ('MIROC', 'MIROC5'),
+    ('CNRM-CERFACS', 'CNRM-CM5')]
+DATA_NODES = [
+    'esgf-data1.ceda.ac.uk',
+    'esgdata.gfdl.noaa.gov',
+    'esgf1.dkrz.de',
+    'esg2.e-inis.ie',
+    'tds.ucar.edu',
+    'crd-esgf-drc.ec.gc.ca']
+EXPERIMENTS = ['historical', 'rcp26', 'rcp45', 'rcp85']
+VARIABLES = ['tasmin', 'tasmax', 'pr']
+
+# Query parameters which are not facet constraints.
+NON_FACET_PARAMS = ['format', 'limit', 'offset', 'distrib', 'shards', 'type',
+                    'facets', 'fields', 'latest', 'query', 'replica']
+
+def _catalog_xml(dataset_id, data_node, layout, files):
+    '''
+    Renders a THREDDS catalog for a dataset. Internal.
+    :param dataset_id: The dataset ID.
+    :param data_node: The data node serving the dataset.
+    :param layout: Either 'fileService' (HTTPServer service nested in a
+        compound fileService) or 'HTTPServer' (HTTPServer service at top level).
+    :param files: A list of dictionaries describing the files.
+    :rtype: String containing the catalog.
+    '''
+    lines = ['<?xml version="1.0" encoding="UTF-8"?>',
+             '<catalog xmlns="%s" xmlns:xlink="http://www.w3.org/1999/xlink" name="TDS configuration file">' % THREDDS_NS]
+    if layout == 'fileService':
+        lines += ['  <service name="fileService" serviceType="Compound" base="">',
+                  '    <service name="HTTPServer" serviceType="HTTPServer" base="/thredds/fileServer/" desc="HTTPServer" />',
+                  '    <service name="OpenDAPServer" serviceType="OpenDAP" base="/thredds/dodsC/" desc="OpenDAP" />',
+                  '  </service>']
+    else:
+        lines += ['  <service name="HTTPServer" serviceType="HTTPServer" base="/thredds/fileServer/" desc="HTTPServer" />',
+                  '  <service name="GRIDFTPServer" serviceType="GridFTP" base="gsiftp://%s:2811//" desc="GridFTP" />' % data_node]
+    lines += ['  <dataset name=%s ID=%s restrictAccess="esg-user">' % (quoteattr(dataset_id), quoteattr(dataset_id)),
+              '    <property name="dataset_id" value=%s />' % quoteattr(dataset_id),
+              '    <property name="data_node" value=%s />' % quoteattr(data_node)]
+    for f in files:
+        lines += ['    <dataset name=%s ID=%s urlPath=%s restrictAccess="esg-user">' % (
+                      quoteattr(f['filename']), quoteattr(dataset_id + '.' + f['filename']), quoteattr(f['url_path'])),
+                  '      <serviceName>HTTPServer</serviceName>',
+                  '      <property name="file_id" value=%s />' % quoteattr(dataset_id + '.' + f['filename']),
+                  '      <property name="size" value="%d" />' % f['size'],
+                  '      <property name="mod_time" value="%s" />' % f['mod_time'],
+                  '      <property name="checksum" value="%s" />' % f['checksum'],
+                  '      <property name="checksum_type" value="MD5" />',
+                  '      <property name="tracking_id" value="%s" />' % f['tracking_id'],
+                  '      <variables vocabulary="CF-1.0">',
+                  '        <variable name="%s" vocabulary_name="%s" units="1">%s</variable>' % (f['variable'], f['variable'], f['variable']),
+                  '      </variables>',
+                  '      <dataSize units="bytes">%d</dataSize>' % f['size'],
+                  '    </dataset>']
+    lines += ['  </dataset>', '</catalog>', '']
+    return '\n'.join(lines)
+
+def generate_fixtures(path,
+                      num_datasets=1000,
+                      files_per_dataset=10,
+                      replicas=0,
+                      layouts=LAYOUTS,
+                      seed=0):
+    '''
+    Generates a set of search results and THREDDS catalogs in the given
+    directory, for use with :func:`serve_fixtures`.
+
+    Each dataset holds a single variable split across time into
+    files_per_dataset files, so the file names carry a time range as real
+    CMIP5 files do. Replicas share a master_id and files with the master
+    copy, but are served from other data nodes.
+
+    :param path: Directory to write fixtures to. Created if absent.
+    :param num_datasets: Number of master datasets to generate.
+    :param files_per_dataset: Number of files in each dataset.
+    :param replicas: Number of replicas of each dataset.
+    :param layouts: THREDDS service layouts to cycle through.
+    :param seed: Random seed, so that fixture sets are reproducible.
+    :rtype: Dictionary summarizing what was generated.
+    '''
+    rng = random.Random(seed)
+    catalog_dir = os.path.join(path, 'catalogs')
+    if not os.path.isdir(catalog_dir):
+        os.makedirs(catalog_dir)
+
+    docs = []
+    num_files = 0
+    for i in range(num_datasets):
+        institute, model = MODELS[i % len(MODELS)]
+        experiment = EXPERIMENTS[(i / len(MODELS)) % len(EXPERIMENTS)]
+        variable = VARIABLES[(i / (len(MODELS) * len(EXPERIMENTS))) % len(VARIABLES)]
+        ensemble = 'r%di1p1' % (i / (len(MODELS) * len(EXPERIMENTS) * len(VARIABLES)) + 1)
+        mod_time = datetime(2011, 1, 1) + timedelta(days=rng.randint(0, 1500), seconds=rng.randint(0, 86399))
+        version = mod_time.strftime('%Y%m%d')
+        master_id = '.'.join(['cmip5', 'output1', institute, model, experiment,
+                              'day', 'atmos', 'day', ensemble, variable])
+        start_year = 1850 if experiment == 'historical' else 2006
+
+        files = []
+        for j in range(files_per_dataset):
+            year = start_year + j * 5
+            filename = '%s_day_%s_%s_%s_%04d0101-%04d1231.nc' % (
+                variable, model, experiment, ensemble, year, year + 4)
+            files.append({
+                'filename': filename,
+                'variable': variable,
+                'size': rng.randint(100, 2000) * 1024 * 1024,
+                'mod_time': mod_time.strftime('%Y-%m-%d %H:%M:%S'),
+                'checksum': hashlib.md5(master_id + filename).hexdigest(),
+                'tracking_id': '%08x-%04x-%04x-%04x-%012x' % tuple(rng.getrandbits(b) for b in (32, 16, 16, 16, 48))})
+        num_files += len(files)
+
+        instance_id = '%s.v%s' % (master_id, version)
+        for f in files:
+            f['url_path'] = 'esg_dataroot/%s/%s' % (instance_id.replace('.', '/'), f['filename'])
+
+        nodes = rng.sample(DATA_NODES, min(replicas + 1, len(DATA_NODES)))
+        for r, data_node in enumerate(nodes):
+            layout = layouts[(i + r) % len(layouts)]
+            catalog_name = '%s_%s.xml' % (instance_id, data_node)
+            with open(os.path.join(catalog_dir, catalog_name), 'w') as fd:
+                fd.write(_catalog_xml(instance_id, data_node, layout, files))
+
+            docs.append({
+                'id': '%s|%s' % (instance_id, data_node),
+                'master_id': master_id,
+                'instance_id': instance_id,
+                'version': version,
+                'replica': r > 0,
+                'latest': True,
+                'data_node': data_node,
+                'index_node': data_node,
+                'project': ['CMIP5'],
+                'product': ['output1'],
+                'institute': [institute],
+                'model': [model],
+                'experiment': [experiment],
+                'time_frequency': ['day'],
+                'realm': ['atmos'],
+                'cmor_table': ['day'],
+                'ensemble': [ensemble],
+                'variable': [variable],
+                'number_of_files': len(files),
+                # Catalog URLs are relative; the server makes them absolute.
+                'url': ['/thredds/catalog/%s#%s|application/xml+thredds|THREDDS' % (catalog_name, instance_id)]})
+
+    with open(os.path.join(path, 'search.json'), 'w') as fd:
+        json.dump(docs, fd)
+
+    summary = {'datasets': num_datasets, 'documents': len(docs), 'files': num_files}
+    log.info('Generated fixtures in %s: %s' % (path, summary))
+    return summary
+
+class FixtureRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    '''
+    Request handler which answers esg-search queries from the generated
+    search results, and THREDDS catalog requests from the generated catalogs.
+    '''
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        if url.path.endswith('/search'):
+            self._search(urlparse.parse_qs(url.query))
+        elif url.path.startswith('/thredds/catalog/'):
+            self._catalog(os.path.basename(url.path))
+        else:
+            self.send_error(404)
+
+    def _reply(self, content_type, body):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _search(self, params):
+        docs = self.server.docs
+        if 'replica' in params:
+            want_replica = params['replica'][0].lower() == 'true'
+            docs = [d for d in docs if d['replica'] == want_replica]
+        for key, values in params.items():
+            if key in NON_FACET_PARAMS:
+                continue
+            docs = [d for d in docs if key in d and
+                    set(d[key] if isinstance(d[key], list) else [d[key]]) & set(values)]
+
+        offset = int(params.get('offset', ['0'])[0])
+        limit = int(params.get('limit', ['10'])[0])
+        base = 'http://%s:%d' % self.server.server_address
+        page = [dict(d, url=[base + u for u in d['url']]) for d in docs[offset:offset + limit]]
+        self._reply('application/json', json.dumps({
+            'responseHeader': {'status': 0, 'params': {'shards': 'localhost:8983/solr/datasets'}},
+            'response': {'numFound': len(docs), 'start': offset, 'docs': page},
+            'facet_counts': {'facet_fields': {}}}))
+
+    def _catalog(self, name):
+        catalog_file = os.path.join(self.server.fixture_path, 'catalogs', name)
+        if not os.path.isfile(catalog_file):
+            self.send_error(404)
+            return
+        with open(catalog_file) as fd:
+            self._reply('application/xml', fd.read())
+
+    def log_message(self, format, *args):
+        log.debug(format % args)
+
+class FixtureServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    '''
+    A stand-in for an ESGF index node and THREDDS server, serving fixtures
+    generated by :func:`generate_fixtures`.
+    '''
+    daemon_threads = True
+
+    def __init__(self, fixture_path, address=('127.0.0.1', 0)):
+        '''
+        Creates a FixtureServer. Call serve_forever (or use :func:`serve_fixtures`) to run it.
+        :param fixture_path: Directory containing generated fixtures.
+        :param address: Address to bind to; port 0 picks a free port.
+        '''
+        BaseHTTPServer.HTTPServer.__init__(self, address, FixtureRequestHandler)
+        self.fixture_path = fixture_path
+        with open(os.path.join(fixture_path, 'search.json')) as fd:
+            self.docs = json.load(fd)
+
+    @property
+    def search_host(self):
+        '''
+        The search host URL to hand to metadata_update.
+        '''
+        return 'http://%s:%d/esg-search' % self.server_address
+
+def serve_fixtures(fixture_path, address=('127.0.0.1', 0)):
+    '''
+    Starts a FixtureServer in a background thread.
+
+    Example::
+     from esgf_download import metadata_update
+     from esgf_download.fixtures import generate_fixtures, serve_fixtures
+     generate_fixtures('/tmp/fixtures', num_datasets=100)
+     server = serve_fixtures('/tmp/fixtures')
+     metadata_update('/tmp/test.db', search_host=server.search_host, project='CMIP5', variable=['pr'])
+     server.shutdown()
+
+    :param fixture_path: Directory containing generated fixtures.
+    :param address: Address to bind to; port 0 picks a free port.
+    :rtype: The running FixtureServer.
+    '''
+    server = FixtureServer(fixture_path, address)
+    server_thread = threading.Thread(target=server.serve_forever, name="FixtureServerThread")
+    server_thread.daemon = True
+    server_thread.start()
+    log.debug('Serving fixtures from %s at %s' % (fixture_path, server.search_host))
+    return server
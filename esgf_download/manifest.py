@@ -0,0 +1,147 @@
+'''
+Export and import of the transfers listed in a database as a manifest, so
+that a second site can seed its database from another site's without
+repeating the crawl.
+
+A manifest has one line per transfer, holding the transfer's metadata along
+with the data node it is fetched from and its model's institute. Manifests are written as JSON
+lines or (for names ending in .csv) CSV, gzip compressed if the name ends
+in .gz. Download state (status, rates, leases and so on) isn't exported;
+imported transfers are waiting.
+'''
+
+import csv
+import gzip
+import json
+import logging
+
+log = logging.getLogger(__name__)
+
+# transfert columns written to manifests. Manifests written before master_id
+# was added are read with it missing, so their transfers are imported without one.
+manifest_transfert_columns = ['model', 'location', 'local_image', 'checksum', 'checksum_type', 'fsize', 'size_xml_tag',
+                              'variable', 'tracking_id', 'version_xml_tag', 'local_product', 'product_xml_tag',
+                              'experiment', 'ensemble', 'time_frequency', 'time_start', 'time_end', 'master_id']
+# model columns written to manifests, with the model's name taken from
+# transfert.model. The data node is the transfer's own, which is also used for
+# a model added on import.
+manifest_model_columns = ['datanode', 'institute']
+manifest_columns = manifest_transfert_columns + manifest_model_columns
+
+def manifest_format(manifest_file):
+    '''
+    Determines a manifest's format from its name.
+    :param manifest_file: Name of the manifest.
+    :rtype: Tuple of the format ('csv' or 'jsonl') and whether it is gzip compressed.
+    '''
+    compressed = manifest_file.endswith('.gz')
+    if compressed:
+        manifest_file = manifest_file[:-3]
+    return ('csv' if manifest_file.endswith('.csv') else 'jsonl'), compressed
+
+def open_manifest(manifest_file, mode):
+    '''
+    Opens a manifest, compressed or not according to its name. Internal.
+    :param manifest_file: Name of the manifest.
+    :param mode: 'rb' or 'wb'.
+    :rtype: File object.
+    '''
+    if manifest_format(manifest_file)[1]:
+        return gzip.open(manifest_file, mode)
+    return open(manifest_file, mode)
+
+def export_manifest(conn, manifest_file):
+    '''
+    Writes every transfer in the database to a manifest.
+    :param conn: sqlite3 connection to the database.
+    :param manifest_file: Name of the manifest to write.
+    :rtype: Number of transfers written.
+    '''
+    format = manifest_format(manifest_file)[0]
+    rows = conn.execute(
+        "SELECT " + ",".join([ "transfert." + c for c in manifest_transfert_columns ] +
+                             [ "IFNULL(transfert.datanode, model.datanode)", "model.institute" ]) + " " +
+        "FROM transfert LEFT JOIN model ON model.name = transfert.model ORDER BY transfert_id")
+    num_rows = 0
+    with open_manifest(manifest_file, 'wb') as f:
+        if format == 'csv':
+            writer = csv.writer(f)
+            writer.writerow(manifest_columns)
+        for row in rows:
+            if format == 'csv':
+                writer.writerow([ '' if x is None else unicode(x).encode('utf-8') for x in row ])
+            else:
+                f.write(json.dumps(dict((c, x) for c, x in zip(manifest_columns, row) if x is not None)) + "\n")
+            num_rows += 1
+    log.info("Exported %d transfers to %s" % (num_rows, manifest_file))
+    return num_rows
+
+def read_manifest(manifest_file):
+    '''
+    Reads the transfers in a manifest, one at a time.
+    :param manifest_file: Name of the manifest to read.
+    :rtype: Iterator over lists of values in the order of manifest_columns;
+        columns missing from a line are None.
+    '''
+    format = manifest_format(manifest_file)[0]
+    with open_manifest(manifest_file, 'rb') as f:
+        if format == 'csv':
+            reader = csv.reader(f)
+            header = reader.next()
+            positions = [ header.index(c) if c in header else None for c in manifest_columns ]
+            for record in reader:
+                yield [ record[i].decode('utf-8') if i is not None and i < len(record) and record[i] != '' else None
+                        for i in positions ]
+        else:
+            for line in f:
+                if line.strip() == '':
+                    continue
+                record = json.loads(line)
+                yield [ record.get(c) for c in manifest_columns ]
+
+def import_manifest(conn, manifest_file):
+    '''
+    Adds the transfers in a manifest to the database as waiting transfers,
+    skipping any whose tracking_id is already present (in the database or
+    earlier in the manifest). The manifest is streamed and the whole import
+    is done in one transaction, so an interrupted import adds nothing.
+
+    :param conn: sqlite3 connection to the database.
+    :param manifest_file: Name of the manifest to read.
+    :rtype: Tuple of the number of transfers added and the number skipped.
+    '''
+    models = {}
+    counts = { 'read': 0 }
+    num_transfert_columns = len(manifest_transfert_columns)
+    model_position = manifest_columns.index('model')
+    tracking_id_position = manifest_columns.index('tracking_id')
+    datanode_position = manifest_columns.index('datanode')
+
+    def transfert_rows():
+        for record in read_manifest(manifest_file):
+            counts['read'] += 1
+            model = record[model_position]
+            if model is not None and model not in models:
+                models[model] = record[num_transfert_columns:]
+            record[num_transfert_columns:] = [ record[datanode_position], record[tracking_id_position] ]
+            yield record
+
+    before = conn.total_changes
+    try:
+        # Transfers without a tracking_id can't be deduplicated, so are always added.
+        conn.executemany(
+            "INSERT INTO transfert(" + ",".join(manifest_transfert_columns) + ", datanode, status) " +
+            "SELECT " + ",".join(["?"] * (len(manifest_transfert_columns) + 1)) + ", 'waiting' " +
+            "WHERE NOT EXISTS (SELECT 1 FROM transfert WHERE tracking_id = ?)", transfert_rows())
+        num_added = conn.total_changes - before
+        for name, (datanode, institute) in models.items():
+            conn.execute(
+                "INSERT INTO model(name, datanode, institute) SELECT ?, ?, ? " +
+                "WHERE NOT EXISTS (SELECT 1 FROM model WHERE name = ?)", [name, datanode, institute, name])
+        conn.commit()
+    except:
+        conn.rollback()
+        raise
+    log.info("Imported %d transfers from %s; skipped %d already present" % (
+        num_added, manifest_file, counts['read'] - num_added))
+    return num_added, counts['read'] - num_added
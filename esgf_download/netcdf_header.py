@@ -0,0 +1,340 @@
+'''
+Incremental parsing of NetCDF headers from the leading bytes of a file as it
+is downloaded, so that a file's dimensions can be recorded without reading
+it back from disk.
+
+The classic formats (CDF-1, 64-bit offset CDF-2 and CDF-5) are supported.
+Their dimension list immediately follows the magic number and record count,
+so it is available from the first few hundred bytes. NetCDF-4 (HDF5) files
+are recognized, but their dimensions are stored in object headers which may
+be anywhere in the file, so they are not parsed.
+
+The whole header of a classic format file (dimensions, attributes and the
+layout of each variable) can also be read, with read_header.
+'''
+
+import struct
+import logging
+
+log = logging.getLogger(__name__)
+
+NC_DIMENSION = 0x0A
+NC_VARIABLE = 0x0B
+NC_ATTRIBUTE = 0x0C
+NC_CHAR = 2
+HDF5_MAGIC = '\x89HDF\r\n\x1a\n'
+
+# Sizes in bytes of the external types, by nc_type.
+type_sizes = { 1: 1, 2: 1, 3: 2, 4: 4, 5: 4, 6: 8, 7: 1, 8: 2, 9: 4, 10: 8, 11: 8 }
+
+# The most bytes buffered while looking for the end of the dimension list.
+MAX_HEADER_BYTES = 64 * 1024
+
+# Dimension names mapped to the transfert columns their lengths are stored in.
+dimension_columns = {
+    'time': 'dimension_time',
+    'lat': 'dimension_lat', 'latitude': 'dimension_lat', 'rlat': 'dimension_lat', 'y': 'dimension_lat', 'j': 'dimension_lat',
+    'lon': 'dimension_lon', 'longitude': 'dimension_lon', 'rlon': 'dimension_lon', 'x': 'dimension_lon', 'i': 'dimension_lon',
+    'lev': 'dimension_lev', 'plev': 'dimension_lev', 'level': 'dimension_lev', 'alevel': 'dimension_lev',
+    'olevel': 'dimension_lev', 'height': 'dimension_lev', 'depth': 'dimension_lev'}
+
+class IncompleteHeader(Exception):
+    '''
+    Raised when more bytes are needed to parse a header. Internal.
+    '''
+    pass
+
+class NetCDFHeaderParser:
+    '''
+    Accumulates the leading chunks of a NetCDF file until its dimensions can
+    be parsed. Only the bytes needed are kept.
+
+    Example::
+     parser = NetCDFHeaderParser()
+     for chunk in chunks:
+         if not parser.done:
+             parser.feed(chunk)
+     print parser.dimensions
+    '''
+    def __init__(self):
+        self.buffer = ''
+        self.done = False
+        self.format = None
+        self.dimensions = None
+        self.record_dimension = None
+
+    def feed(self, chunk):
+        '''
+        Adds a chunk of the file, parsing the header if enough is available.
+        :param chunk: The next chunk of the file.
+        '''
+        if self.done:
+            return
+        self.buffer += chunk[:MAX_HEADER_BYTES - len(self.buffer)]
+        try:
+            self._parse()
+            self.done = True
+        except IncompleteHeader:
+            if len(self.buffer) >= MAX_HEADER_BYTES:
+                log.debug("NetCDF dimension list not found in the first %d bytes" % MAX_HEADER_BYTES)
+                self.done = True
+        except ValueError as e:
+            log.debug("Not parsing NetCDF header: " + str(e))
+            self.done = True
+        if self.done:
+            self.buffer = ''
+
+    def _unpack(self, fmt, offset):
+        size = struct.calcsize(fmt)
+        if len(self.buffer) < offset + size:
+            raise IncompleteHeader()
+        return struct.unpack(fmt, self.buffer[offset:offset + size]), offset + size
+
+    def _parse(self):
+        if len(self.buffer) < 8:
+            raise IncompleteHeader()
+        if self.buffer.startswith(HDF5_MAGIC):
+            self.format = 'HDF5'
+            raise ValueError("NetCDF-4 (HDF5) dimensions are not parsed from the stream")
+        if self.buffer[:3] != 'CDF' or self.buffer[3] not in '\x01\x02\x05':
+            raise ValueError("not a NetCDF file")
+        version = ord(self.buffer[3])
+        self.format = 'CDF%d' % version
+        # CDF-5 uses 64-bit counts and lengths.
+        size_fmt = '>Q' if version == 5 else '>I'
+
+        (numrecs,), offset = self._unpack(size_fmt, 4)
+        (tag,), offset = self._unpack('>I', offset)
+        (nelems,), offset = self._unpack(size_fmt, offset)
+        if tag != NC_DIMENSION and not (tag == 0 and nelems == 0):
+            raise ValueError("malformed dimension list")
+
+        dimensions = {}
+        for i in range(nelems):
+            (name_len,), offset = self._unpack(size_fmt, offset)
+            padded_len = (name_len + 3) & ~3
+            if len(self.buffer) < offset + padded_len:
+                raise IncompleteHeader()
+            name = self.buffer[offset:offset + name_len]
+            offset += padded_len
+            (dim_len,), offset = self._unpack(size_fmt, offset)
+            if dim_len == 0:
+                # The record dimension; its length is the number of records,
+                # unless the file was still being written (numrecs = STREAMING).
+                self.record_dimension = name
+                dim_len = None if numrecs in (0xFFFFFFFF, 0xFFFFFFFFFFFFFFFF) else numrecs
+            dimensions[name] = dim_len
+        self.dimensions = dimensions
+
+    def dimension_fields(self):
+        '''
+        Maps the parsed dimensions onto the transfert table's dimension columns.
+        The record dimension is taken to be time if no dimension is named time.
+        :rtype: Dictionary of column name to dimension length; empty if the
+            dimensions weren't parsed.
+        '''
+        fields = {}
+        if self.dimensions is None:
+            return fields
+        for name, length in self.dimensions.items():
+            column = dimension_columns.get(name.lower())
+            if column is not None and column not in fields:
+                fields[column] = length
+        if 'dimension_time' not in fields and self.record_dimension is not None:
+            fields['dimension_time'] = self.dimensions[self.record_dimension]
+        return fields
+
+class NetCDFVariable:
+    '''
+    The layout of a variable in a classic format NetCDF file.
+    '''
+    def __init__(self, name, dimensions, attributes, nc_type, vsize, begin, is_record):
+        '''
+        Creates a NetCDFVariable.
+        :param name: The variable's name.
+        :param dimensions: List of the names of its dimensions.
+        :param attributes: Dictionary of its attributes; see NetCDFHeader.
+        :param nc_type: Its external type.
+        :param vsize: Its size in bytes (per record, for record variables).
+        :param begin: Offset of its data (of its first record, for record variables).
+        :param is_record: Whether it varies along the record dimension.
+        '''
+        self.name = name
+        self.dimensions = dimensions
+        self.attributes = attributes
+        self.nc_type = nc_type
+        self.vsize = vsize
+        self.begin = begin
+        self.is_record = is_record
+
+class NetCDFHeader:
+    '''
+    The header of a classic format NetCDF file. Text attributes are decoded;
+    other attributes are kept as the raw bytes of their values.
+    '''
+    def __init__(self, version, numrecs, dimensions, record_dimension, attributes, variables, length):
+        '''
+        Creates a NetCDFHeader.
+        :param version: Format version (1, 2 or 5).
+        :param numrecs: Number of records, or None if the file was still being written.
+        :param dimensions: List of (name, length) tuples; the record
+            dimension's length is None.
+        :param record_dimension: Name of the record dimension, or None.
+        :param attributes: Dictionary of global attributes.
+        :param variables: List of NetCDFVariables, in file order.
+        :param length: Length of the header in bytes.
+        '''
+        self.version = version
+        self.numrecs = numrecs
+        self.dimensions = dimensions
+        self.record_dimension = record_dimension
+        self.attributes = attributes
+        self.variables = variables
+        self.length = length
+
+    def record_variables(self):
+        return [ var for var in self.variables if var.is_record ]
+
+    def record_size(self):
+        '''
+        Returns the size in bytes of one record: the sum of the record
+        variables' sizes, or the unpadded size if there is only one.
+        '''
+        record_variables = self.record_variables()
+        if len(record_variables) == 1:
+            var = record_variables[0]
+            lengths = dict(self.dimensions)
+            size = type_sizes[var.nc_type]
+            for name in var.dimensions[1:]:
+                size *= lengths[name]
+            return size
+        return sum([ v.vsize for v in record_variables ])
+
+    def record_begin(self):
+        '''
+        Returns the offset of the first record, or None if there are no record variables.
+        '''
+        record_variables = self.record_variables()
+        if len(record_variables) == 0:
+            return None
+        return min([ var.begin for var in record_variables ])
+
+    def numrecs_format(self):
+        '''
+        Returns the struct format of the record count, which follows the magic number.
+        '''
+        return '>Q' if self.version == 5 else '>I'
+
+class HeaderReader:
+    '''
+    Reads the values making up a header in order. Internal.
+    '''
+    def __init__(self, buffer, version):
+        self.buffer = buffer
+        self.offset = 4
+        # CDF-5 uses 64-bit counts and lengths; CDF-2 and CDF-5 use 64-bit offsets.
+        self.size_fmt = '>Q' if version == 5 else '>I'
+        self.begin_fmt = '>I' if version == 1 else '>Q'
+
+    def unpack(self, fmt):
+        size = struct.calcsize(fmt)
+        if len(self.buffer) < self.offset + size:
+            raise IncompleteHeader()
+        value = struct.unpack(fmt, self.buffer[self.offset:self.offset + size])[0]
+        self.offset += size
+        return value
+
+    def size(self):
+        return self.unpack(self.size_fmt)
+
+    def padded(self, length):
+        padded_len = (length + 3) & ~3
+        if len(self.buffer) < self.offset + padded_len:
+            raise IncompleteHeader()
+        value = self.buffer[self.offset:self.offset + length]
+        self.offset += padded_len
+        return value
+
+    def name(self):
+        return self.padded(self.size())
+
+    def list_length(self, expected_tag):
+        tag = self.unpack('>I')
+        length = self.size()
+        if tag != expected_tag and not (tag == 0 and length == 0):
+            raise ValueError("malformed header")
+        return length
+
+    def attributes(self):
+        attributes = {}
+        for i in range(self.list_length(NC_ATTRIBUTE)):
+            name = self.name()
+            nc_type = self.unpack('>I')
+            if nc_type not in type_sizes:
+                raise ValueError("unknown type %d" % nc_type)
+            value = self.padded(self.size() * type_sizes[nc_type])
+            attributes[name] = value.rstrip('\0') if nc_type == NC_CHAR else value
+        return attributes
+
+def parse_header(buffer):
+    '''
+    Parses the header of a classic format NetCDF file. Internal.
+    :param buffer: The leading bytes of the file.
+    :raises IncompleteHeader: If the buffer doesn't hold the whole header.
+    :raises ValueError: If the file isn't a classic format NetCDF file.
+    :rtype: NetCDFHeader.
+    '''
+    if len(buffer) < 4:
+        raise IncompleteHeader()
+    if buffer.startswith(HDF5_MAGIC[:4]):
+        raise ValueError("NetCDF-4 (HDF5) headers are not parsed")
+    if buffer[:3] != 'CDF' or buffer[3] not in '\x01\x02\x05':
+        raise ValueError("not a NetCDF file")
+    version = ord(buffer[3])
+    reader = HeaderReader(buffer, version)
+    numrecs = reader.size()
+    if numrecs in (0xFFFFFFFF, 0xFFFFFFFFFFFFFFFF):
+        numrecs = None
+
+    dimensions = []
+    record_dimension = None
+    for i in range(reader.list_length(NC_DIMENSION)):
+        name = reader.name()
+        length = reader.size()
+        if length == 0:
+            record_dimension = name
+            length = None
+        dimensions.append((name, length))
+    attributes = reader.attributes()
+
+    variables = []
+    for i in range(reader.list_length(NC_VARIABLE)):
+        name = reader.name()
+        var_dimensions = [ dimensions[reader.size()][0] for j in range(reader.size()) ]
+        var_attributes = reader.attributes()
+        nc_type = reader.unpack('>I')
+        vsize = reader.size()
+        begin = reader.unpack(reader.begin_fmt)
+        is_record = len(var_dimensions) > 0 and var_dimensions[0] == record_dimension
+        variables.append(NetCDFVariable(name, var_dimensions, var_attributes, nc_type, vsize, begin, is_record))
+    return NetCDFHeader(version, numrecs, dimensions, record_dimension, attributes, variables, reader.offset)
+
+def read_header(f):
+    '''
+    Reads the header of a classic format NetCDF file, reading little more
+    of the file than the header itself.
+    :param f: File object open for reading, positioned at the start of the file.
+    :raises ValueError: If the file isn't a classic format NetCDF file.
+    :rtype: NetCDFHeader.
+    '''
+    buffer = ''
+    read_size = MAX_HEADER_BYTES
+    while True:
+        chunk = f.read(read_size)
+        buffer += chunk
+        try:
+            return parse_header(buffer)
+        except IncompleteHeader:
+            if chunk == '':
+                raise ValueError("truncated header")
+        read_size = len(buffer)
@@ -0,0 +1,120 @@
+'''
+An on-disk cache of ESGF search results, so that repeated harvests with the
+same (or overlapping) constraints needn't page through the search results
+again.
+
+Each cached search is stored as a gzipped file of JSON lines: a header
+giving the search host, constraints and time of the search, followed by one
+dataset record per line. Files are named by a hash of the search host and
+the normalized constraints, and are only written once a search has been
+read to the end, so an interrupted search is never cached.
+'''
+
+import os
+import json
+import gzip
+import time
+import errno
+import hashlib
+import logging
+
+log = logging.getLogger(__name__)
+
+def normalize_constraints(constraints):
+    '''
+    Puts search constraints in a canonical form, so that equivalent
+    constraint sets compare (and hash) equal: constraints which are None are
+    dropped, and each value becomes a sorted list of distinct strings.
+    :param constraints: Dictionary of facet name to value or list of values.
+    :rtype: Dictionary of facet name to sorted list of strings.
+    '''
+    normalized = {}
+    for name, value in constraints.items():
+        if value is None:
+            continue
+        if not isinstance(value, (list, tuple, set)):
+            value = [value]
+        normalized[name] = sorted(set([ unicode(v) for v in value ]))
+    return normalized
+
+class SearchCache:
+    '''
+    A directory of cached search results which expire after a time.
+    '''
+    def __init__(self, cache_dir, ttl=86400):
+        '''
+        Creates a SearchCache.
+        :param cache_dir: Directory to keep cached results in. Created if need be.
+        :param ttl: Time in seconds cached results are used for.
+        '''
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        try:
+            os.makedirs(cache_dir)
+        except os.error as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def path(self, search_host, constraints):
+        '''
+        Returns the file a search's results are cached in.
+        :param search_host: The search host.
+        :param constraints: The search's constraints.
+        :rtype: Path of the file.
+        '''
+        key = json.dumps([search_host, normalize_constraints(constraints)], sort_keys=True)
+        return os.path.join(self.cache_dir, hashlib.sha1(key).hexdigest() + '.jsonl.gz')
+
+    def get(self, search_host, constraints):
+        '''
+        Reads a search's results from the cache.
+        :param search_host: The search host.
+        :param constraints: The search's constraints.
+        :rtype: Iterator over the dataset records, or None if the search
+            isn't cached or its results have expired.
+        '''
+        path = self.path(search_host, constraints)
+        try:
+            f = gzip.open(path, 'rb')
+            header = json.loads(f.readline())
+        except (IOError, ValueError):
+            return None
+        if header['created'] + self.ttl < time.time():
+            f.close()
+            log.debug("Cached search results in %s have expired" % path)
+            return None
+        log.debug("Using cached search results from %s" % path)
+        return self._read(f)
+
+    def _read(self, f):
+        with f:
+            for line in f:
+                yield json.loads(line)
+
+    def store(self, search_host, constraints, records):
+        '''
+        Caches a search's results as they are read.
+        :param search_host: The search host.
+        :param constraints: The search's constraints.
+        :param records: Iterator over the search's dataset records.
+        :rtype: Iterator over the same records. The results are cached
+            once it has been read to the end.
+        '''
+        path = self.path(search_host, constraints)
+        temp_path = "%s.%d.tmp" % (path, os.getpid())
+        f = gzip.open(temp_path, 'wb')
+        complete = False
+        try:
+            f.write(json.dumps({ 'search_host': search_host,
+                                 'constraints': normalize_constraints(constraints),
+                                 'created': time.time() }) + "\n")
+            for record in records:
+                f.write(json.dumps(record) + "\n")
+                yield record
+            complete = True
+        finally:
+            f.close()
+            if complete:
+                os.rename(temp_path, path)
+            else:
+                os.unlink(temp_path)
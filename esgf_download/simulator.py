@@ -0,0 +1,377 @@
+'''
+Offline discrete-event simulation of the Downloader's scheduling, so that
+thread limits and the order in which transfers are started can be compared
+in seconds instead of by trial on live data nodes.
+
+Each data node is modelled from the transfers it has already served (see
+model_hosts): a rate per connection, an aggregate bandwidth, a setup latency
+and an error rate. Transfers are then started in simulated time the way
+Downloader.start_downloads starts them: a host starts queued transfers
+while it is under its thread limit, the total is under the global limit and
+its spawn interval has passed. When the global limit leaves fewer slots
+than the hosts could use, they go to the transfers which come first under
+the scheduling policy (see policies). A failed transfer
+holds its slot for as long as failures on its host typically take and is not
+retried, as in the Downloader.
+
+Between events (a transfer starting to receive data, finishing or failing,
+or a host's spawn interval passing), the transfers receiving data from a
+host share its bandwidth equally, each getting at most the host's rate per
+connection.
+'''
+
+import heapq
+import random
+import itertools
+import logging
+
+log = logging.getLogger(__name__)
+
+size_sql = "CAST(COALESCE(fsize, size_xml_tag) AS INTEGER)"
+
+# Orders in which each host's queued transfers are started, as keys on
+# (transfert_id, size) tuples. 'fifo' is the Downloader's order.
+policies = {
+    'fifo': lambda transfer: transfer[0],
+    'largest_first': lambda transfer: -transfer[1],
+    'smallest_first': lambda transfer: transfer[1]}
+
+def median(values):
+    '''
+    Returns the median of a list of numbers. Internal.
+    :param values: List of numbers.
+    :rtype: The median, or None if the list is empty.
+    '''
+    if len(values) == 0:
+        return None
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2 == 1:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+def peak_throughput(intervals):
+    '''
+    Finds the highest aggregate rate reached by overlapping transfers. Internal.
+    :param intervals: List of (start time, end time, rate) tuples.
+    :rtype: Tuple of the peak aggregate rate and the most transfers running at once.
+    '''
+    changes = []
+    for start, end, rate in intervals:
+        changes.append((start, 1, rate))
+        changes.append((end, -1, -rate))
+    # Transfers ending at a time are removed before those starting then are added.
+    changes.sort(key=lambda change: (change[0], change[1]))
+    throughput = peak = 0.0
+    running = peak_running = 0
+    for when, count, rate in changes:
+        throughput += rate
+        running += count
+        peak = max(peak, throughput)
+        peak_running = max(peak_running, running)
+    return peak, peak_running
+
+class HostModel:
+    '''
+    How a data node serves downloads.
+    '''
+    def __init__(self, datanode, rate, bandwidth=None, latency=0.0, error_rate=0.0, error_time=0.0,
+                 estimated=False):
+        '''
+        Creates a HostModel.
+        :param datanode: The data node.
+        :param rate: Rate in bytes per second of one connection.
+        :param bandwidth: Aggregate rate in bytes per second shared by all
+            connections, or None for no limit beyond the rate per connection.
+        :param latency: Time in seconds from starting a transfer to receiving data.
+        :param error_rate: Fraction of transfers which fail.
+        :param error_time: Time in seconds a failing transfer takes to fail.
+        :param estimated: Whether the model was guessed from other hosts,
+            for want of history.
+        '''
+        self.datanode = datanode
+        self.rate = rate
+        self.bandwidth = bandwidth
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error_time = error_time
+        self.estimated = estimated
+
+def model_hosts(conn, cap_bandwidth=True):
+    '''
+    Estimates a HostModel for each data node from the completed and failed
+    transfers in the transfert table.
+
+    The rate per connection is the median rate at which completed transfers
+    received data, and the latency the median connect and first byte time.
+    The bandwidth is the highest aggregate rate the host's completed
+    transfers were seen to reach together; a host is taken to be unable to
+    serve more than that, however many connections are used, unless
+    cap_bandwidth is False. Only transfers recorded with start and end
+    times in seconds (as the Downloader records them) count towards it.
+
+    :param conn: sqlite3 connection to the database, opened with
+        esgf_download.open_database so that its schema is up to date.
+    :param cap_bandwidth: Whether to limit each host to the highest
+        aggregate rate it has been seen to reach.
+    :rtype: Dictionary of data node to HostModel. Data nodes without
+        completed transfers are left out.
+    '''
+    history = {}
+    for datanode, status, size, duration, start, end, connect_time, ttfb_time in conn.execute(
+            "SELECT datanode, status, " + size_sql + ", duration, CAST(start_date AS REAL), CAST(end_date AS REAL), " +
+            "connect_time, ttfb_time FROM transfert " +
+            "WHERE status IN ('done', 'error') AND duration IS NOT NULL"):
+        host = history.setdefault(datanode, { 'rates': [], 'latencies': [], 'intervals': [],
+                                              'done': 0, 'errors': 0, 'error_times': [] })
+        if status == 'error':
+            host['errors'] += 1
+            host['error_times'].append(duration)
+            continue
+        host['done'] += 1
+        if size is None or size <= 0 or duration <= 0:
+            continue
+        # Transfers recorded before phases were timed have no latency.
+        latency = 0.0
+        if connect_time is not None and ttfb_time is not None:
+            latency = connect_time + ttfb_time
+            host['latencies'].append(latency)
+        if duration > latency:
+            host['rates'].append(size / (duration - latency))
+        if start > 0 and end > start:
+            host['intervals'].append((start, end, size / duration))
+
+    models = {}
+    for datanode, host in history.items():
+        rate = median(host['rates'])
+        if rate is None:
+            continue
+        bandwidth = None
+        if cap_bandwidth and len(host['intervals']) > 0:
+            peak, peak_running = peak_throughput(host['intervals'])
+            bandwidth = max(peak, rate)
+            log.debug("%s: peak of %.0f bytes/s with up to %d transfers at once" % (datanode, peak, peak_running))
+        models[datanode] = HostModel(datanode, rate, bandwidth,
+                                     median(host['latencies']) or 0.0,
+                                     float(host['errors']) / (host['done'] + host['errors']),
+                                     median(host['error_times']) or 0.0)
+    return models
+
+def load_workload(conn, statuses=('waiting',)):
+    '''
+    Reads the transfers to simulate from the transfert table.
+    :param conn: sqlite3 connection to the database.
+    :param statuses: Statuses of the transfers to include; None for all.
+    :rtype: Tuple of a dictionary of data node to list of (transfert_id,
+        size) tuples in transfert_id order, and the number of transfers left
+        out because their size isn't known.
+    '''
+    query = "SELECT datanode, transfert_id, " + size_sql + " FROM transfert"
+    args = []
+    if statuses is not None:
+        query += " WHERE status IN (" + ",".join(["?"] * len(statuses)) + ")"
+        args = list(statuses)
+    workload = {}
+    unsized = 0
+    for datanode, transfert_id, size in conn.execute(query + " ORDER BY transfert_id", args):
+        if size is None:
+            unsized += 1
+            continue
+        workload.setdefault(datanode, []).append((transfert_id, size))
+    return workload, unsized
+
+class SimulatedHost:
+    '''
+    A host's state during a simulation. Internal.
+    '''
+    def __init__(self, model, transfers, key):
+        self.model = model
+        self.queue = sorted(transfers, key=key)
+        self.next = 0
+        self.threads = 0
+        self.last_spawn_time = None
+        # Whether the host is among those which may be able to start a transfer.
+        self.ready = False
+        # Transfers receiving data all receive at the same rate, so each is
+        # kept as the amount received per transfer at which it finishes.
+        # The amount received is brought up to date when the rate changes.
+        self.receiving = []
+        self.received = 0.0
+        self.rate = 0.0
+        self.updated = 0.0
+        # Incremented when the rate changes, so that finishing events
+        # scheduled at the old rate can be recognized as out of date.
+        self.version = 0
+        self.thread_seconds = 0.0
+        self.files = 0
+        self.bytes = 0
+        self.failed = 0
+        self.finish = None
+
+    def has_queued(self):
+        return self.next < len(self.queue)
+
+    def head(self):
+        return self.queue[self.next]
+
+    def advance(self, now):
+        '''
+        Brings the amount received and thread time used up to the given time.
+        '''
+        elapsed = now - self.updated
+        self.received += self.rate * elapsed
+        self.thread_seconds += self.threads * elapsed
+        self.updated = now
+
+    def next_finish(self):
+        '''
+        Recomputes the rate at which each transfer receiving data receives
+        it, after the transfers receiving have changed.
+        :rtype: Time at which the next of them finishes, or None if none are receiving.
+        '''
+        self.version += 1
+        if len(self.receiving) == 0:
+            self.rate = 0.0
+            return None
+        self.rate = self.model.rate
+        if self.model.bandwidth is not None:
+            self.rate = min(self.rate, self.model.bandwidth / len(self.receiving))
+        return self.updated + max(self.receiving[0] - self.received, 0.0) / self.rate
+
+def simulate(models, workload, threads_per_host=3, max_total_threads=100, policy='fifo',
+             spawn_interval=0.0, seed=0):
+    '''
+    Simulates downloading a workload with the given limits and policy.
+
+    Hosts in the workload without a model are assumed to serve at the mean
+    rate per connection of the modelled hosts, without a bandwidth limit,
+    latency or errors.
+
+    :param models: Dictionary of data node to HostModel; see model_hosts.
+    :param workload: Dictionary of data node to list of (transfert_id,
+        size) tuples; see load_workload.
+    :param threads_per_host: Thread limit per host.
+    :param max_total_threads: Thread limit over all hosts.
+    :param policy: Order in which each host's transfers are started; one
+        of the keys of policies.
+    :param spawn_interval: Minimum time in seconds between starting
+        transfers from any one host.
+    :param seed: Seed for the random choice of which transfers fail.
+    :raises ValueError: If no host has a model to go by, or the policy is unknown.
+    :rtype: Dictionary with keys makespan (seconds), files, bytes, failed
+        and hosts: a list of dictionaries, one per host, with keys datanode,
+        files, bytes, failed, finish (seconds from the start),
+        thread_seconds, slot_utilization (fraction of the host's thread
+        slots in use until it finished), bandwidth_utilization (fraction of
+        its bandwidth used until it finished, or None if it has no
+        bandwidth limit) and estimated, in order of finishing time, last first.
+    '''
+    if policy not in policies:
+        raise ValueError("Unknown policy: " + policy)
+    if len(models) == 0:
+        raise ValueError("No completed transfers to model hosts on")
+    key = policies[policy]
+    mean_rate = sum([ model.rate for model in models.values() ]) / len(models)
+    hosts = []
+    for datanode, transfers in sorted(workload.items()):
+        model = models.get(datanode) or HostModel(datanode, mean_rate, estimated=True)
+        hosts.append(SimulatedHost(model, transfers, key))
+
+    rng = random.Random(seed)
+    # Events are (time, sequence, kind, host, data) tuples; data is the
+    # size for 'receive' events and the host's version for 'finish' events.
+    events = []
+    sequence = itertools.count()
+    state = { 'now': 0.0, 'threads': 0 }
+    # Hosts which may be able to start a transfer, by their next transfer's key.
+    ready = []
+
+    def receive(host, size):
+        host.advance(state['now'])
+        heapq.heappush(host.receiving, host.received + size)
+        host.bytes += size
+        when = host.next_finish()
+        heapq.heappush(events, (when, next(sequence), 'finish', host, host.version))
+
+    def wake(host):
+        # Offers a host which may be able to start a transfer a slot.
+        if not host.ready and host.has_queued() and host.threads < threads_per_host:
+            host.ready = True
+            heapq.heappush(ready, (key(host.head()), next(sequence), host))
+
+    def start_transfers():
+        # As Downloader.start_downloads, but when the global limit leaves
+        # fewer slots than hosts could use, the transfer started next is the
+        # first under the policy among those the hosts could start.
+        now = state['now']
+        while len(ready) > 0 and state['threads'] < max_total_threads:
+            host = heapq.heappop(ready)[2]
+            host.ready = False
+            if host.last_spawn_time is not None and now < host.last_spawn_time + spawn_interval:
+                # The 'spawn' event offers the host a slot again.
+                heapq.heappush(events, (host.last_spawn_time + spawn_interval, next(sequence), 'spawn', host, None))
+                continue
+            transfert_id, size = host.head()
+            host.next += 1
+            host.advance(now)
+            host.threads += 1
+            state['threads'] += 1
+            host.last_spawn_time = now
+            if rng.random() < host.model.error_rate:
+                heapq.heappush(events, (now + host.model.error_time, next(sequence), 'error', host, None))
+            elif host.model.latency > 0:
+                heapq.heappush(events, (now + host.model.latency, next(sequence), 'receive', host, size))
+            else:
+                receive(host, size)
+            wake(host)
+
+    def end_transfer(host):
+        host.threads -= 1
+        state['threads'] -= 1
+        if host.threads == 0 and not host.has_queued():
+            host.finish = state['now']
+
+    for host in hosts:
+        wake(host)
+    start_transfers()
+    while len(events) > 0:
+        when, _, kind, host, data = heapq.heappop(events)
+        if kind == 'finish' and data != host.version:
+            continue
+        state['now'] = when
+        host.advance(when)
+        if kind == 'finish':
+            host.received = max(host.received, host.receiving[0])
+            while len(host.receiving) > 0 and host.receiving[0] <= host.received:
+                heapq.heappop(host.receiving)
+                host.files += 1
+                end_transfer(host)
+            next_time = host.next_finish()
+            if next_time is not None:
+                heapq.heappush(events, (next_time, next(sequence), 'finish', host, host.version))
+        elif kind == 'receive':
+            receive(host, data)
+        elif kind == 'error':
+            host.failed += 1
+            end_transfer(host)
+        wake(host)
+        start_transfers()
+
+    makespan = state['now']
+    results = []
+    for host in hosts:
+        host.advance(makespan)
+        finish = host.finish if host.finish is not None else makespan
+        bandwidth_utilization = None
+        if host.model.bandwidth is not None and finish > 0:
+            bandwidth_utilization = host.bytes / (host.model.bandwidth * finish)
+        results.append({ 'datanode': host.model.datanode, 'files': host.files, 'bytes': host.bytes,
+                         'failed': host.failed, 'finish': finish, 'thread_seconds': host.thread_seconds,
+                         'slot_utilization': host.thread_seconds / (threads_per_host * finish) if finish > 0 else None,
+                         'bandwidth_utilization': bandwidth_utilization, 'estimated': host.model.estimated })
+    results.sort(key=lambda host: host['finish'], reverse=True)
+    return { 'makespan': makespan,
+             'files': sum([ host['files'] for host in results ]),
+             'bytes': sum([ host['bytes'] for host in results ]),
+             'failed': sum([ host['failed'] for host in results ]),
+             'hosts': results }
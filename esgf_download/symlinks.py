@@ -0,0 +1,149 @@
+'''
+Incremental maintenance of a symlink tree over downloaded CMIP5 data.
+
+For each variable-model-emissions-run-time resolution-version combination
+the tree links to a single file covering the whole time range available,
+chosen the same way as ``create.cmip5.symlink.tree`` in
+``scripts/aggregate_and_rename.r``. Rather than rebuilding the whole tree,
+only the combinations containing newly downloaded files are revisited; the
+files making up a combination are found from the transfert table, so no
+directory listing or file reading is needed.
+'''
+
+import os
+import errno
+import logging
+
+log = logging.getLogger(__name__)
+
+def split_filename(filename):
+    '''
+    Splits a CMIP5 filename (eg pr_day_CCSM4_rcp45_r1i1p1_20060101-20101231.nc)
+    into its parts, as get.split.filename does.
+
+    :param filename: The file's name, without directories.
+    :rtype: Dictionary with keys var, tres, model, emissions, run, tstart and
+        tend; tstart and tend are None for files without a time range.
+    '''
+    parts = os.path.splitext(filename)[0].split('_')
+    fields = dict(zip(['var', 'tres', 'model', 'emissions', 'run', 'trange'], parts))
+    fields['tstart'] = fields['tend'] = None
+    if 'trange' in fields and '-' in fields['trange']:
+        fields['tstart'], fields['tend'] = fields['trange'].split('-', 1)
+    return fields
+
+def choose_file(filenames):
+    '''
+    Chooses the file to link to among the files of one combination: the
+    only file if there is one, otherwise the first file covering the whole
+    time range spanned by the files, or None if no file does.
+
+    :param filenames: List of filenames (without directories).
+    :rtype: The chosen filename, or None.
+    '''
+    if len(filenames) == 1:
+        return filenames[0]
+    try:
+        ranges = [ (f, int(split_filename(f)['tstart']), int(split_filename(f)['tend'])) for f in filenames ]
+    except (TypeError, ValueError):
+        return None
+    first = min([ r[1] for r in ranges ] + [ r[2] for r in ranges ])
+    last = max([ r[1] for r in ranges ] + [ r[2] for r in ranges ])
+    for f, tstart, tend in ranges:
+        if tstart <= first and tend >= last:
+            return f
+    return None
+
+class SymlinkTree:
+    '''
+    A symlink tree, laid out as <institute>/<model>/<emissions>/<tres>/atmos/<tres>/<run>/<version>/<var>,
+    linking to files under the download base path.
+    '''
+    def __init__(self, base_path, symlink_root):
+        '''
+        Creates a SymlinkTree.
+        :param base_path: Base path downloaded files are stored in.
+        :param symlink_root: Root directory of the symlink tree.
+        '''
+        self.base_path = os.path.abspath(base_path)
+        self.symlink_root = symlink_root
+
+    def symlink_dir(self, local_image):
+        '''
+        Returns the directory in the symlink tree for a downloaded file.
+        :param local_image: Path of the file relative to the base path, as
+            stored in the transfert table.
+        :rtype: Path of the directory, or None if the file isn't a CMIP5 file
+            with a time range.
+        '''
+        path_parts = local_image.split('/')
+        fields = split_filename(path_parts[-1])
+        if fields['tstart'] is None or len(path_parts) < 12:
+            return None
+        institute, version = path_parts[-10], path_parts[-3]
+        return os.path.join(self.symlink_root, institute, fields['model'], fields['emissions'], fields['tres'],
+                            'atmos', fields['tres'], fields['run'], version, fields['var'])
+
+    def update(self, conn, local_image):
+        '''
+        Brings the links for the combination containing a downloaded file up
+        to date. Links to files of the combination which are no longer the
+        right choice are removed.
+
+        :param conn: sqlite3 connection to the database.
+        :param local_image: Path of the file relative to the base path, as
+            stored in the transfert table.
+        :rtype: Path of the link to the chosen file, or None if none was chosen.
+        '''
+        link_dir = self.symlink_dir(local_image)
+        if link_dir is None:
+            return None
+
+        # The combination's files all live in one directory; a range query
+        # on local_image finds them using its index.
+        image_dir = os.path.dirname(local_image) + '/'
+        filenames = [ os.path.basename(row[0]) for row in conn.execute(
+            "SELECT local_image FROM transfert WHERE local_image >= ? AND local_image < ? AND status = 'done'",
+            [image_dir, image_dir[:-1] + chr(ord('/') + 1)]) ]
+        filenames = [ f for f in filenames if os.path.exists(os.path.join(self.base_path, image_dir, f)) ]
+        chosen = choose_file(sorted(filenames)) if len(filenames) > 0 else None
+
+        for f in filenames:
+            link = os.path.join(link_dir, f)
+            if f != chosen and os.path.islink(link):
+                log.debug("Removing superseded link " + link)
+                os.unlink(link)
+        if chosen is None:
+            return None
+
+        try:
+            os.makedirs(link_dir)
+        except os.error as e:
+            if e.errno != errno.EEXIST:
+                raise
+        link = os.path.join(link_dir, chosen)
+        if not os.path.lexists(link):
+            log.debug("Linking " + link)
+            os.symlink(os.path.join(self.base_path, image_dir, chosen), link)
+        return link
+
+    def update_done_since(self, conn, since=None):
+        '''
+        Brings the links up to date for every combination with a transfer
+        completed since the given time.
+
+        :param conn: sqlite3 connection to the database.
+        :param since: Time in seconds since the epoch; None for all time.
+        :rtype: Number of combinations updated.
+        '''
+        query = "SELECT local_image FROM transfert WHERE status = 'done'"
+        args = []
+        if since is not None:
+            query += " AND CAST(end_date AS REAL) >= ?"
+            args.append(since)
+        image_dirs = {}
+        for (local_image,) in conn.execute(query, args):
+            image_dirs.setdefault(os.path.dirname(local_image), local_image)
+        for local_image in image_dirs.values():
+            self.update(conn, local_image)
+        return len(image_dirs)
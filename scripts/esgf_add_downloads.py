@@ -1,6 +1,7 @@
 #!/usr/bin/python
 
 import esgf_download
+from esgf_download.search_cache import SearchCache
 import logging
 import sys
 import argparse
@@ -24,6 +25,13 @@ def update_metadata(args):
     logging.basicConfig(stream=vars(args).pop('log_output', None), level=vars(args).pop('log_level', None).upper())
     static_args = ['database']
     static_arg_vals = [vars(args).pop(k, None) for k in static_args]
+    search_cache_dir = vars(args).pop('search_cache', None)
+    search_cache_ttl = vars(args).pop('search_cache_ttl', None)
+    if search_cache_dir is not None:
+        args.search_cache = SearchCache(search_cache_dir, search_cache_ttl * 3600)
+    refresh_older_than = vars(args).pop('refresh_older_than', None)
+    if refresh_older_than is not None:
+        args.refresh_older_than = refresh_older_than * 3600
     esgf_download.metadata_update(*static_arg_vals, **vars(args))
     
 if __name__ == '__main__':
@@ -46,6 +54,16 @@ if __name__ == '__main__':
     g1.add_argument('-s', '--search-host',
                        default='http://pcmdi.llnl.gov/esg-search',
                        help="Search host")
+    g1.add_argument('-c', '--search-cache',
+                       help="Directory to cache search results in. Defaults to not caching")
+    g1.add_argument('--search-cache-ttl',
+                       type=float, default=24,
+                       help="Hours cached search results are used for")
+    g1.add_argument('--shard-facet',
+                       help='Search for each value of this facet separately (eg "variable"), so that adding a value later only searches for the new value')
+    g1.add_argument('--refresh-older-than',
+                       type=float,
+                       help="Process datasets again if this harvest processed them more than this many hours ago. By default, a harvest which was run before only processes the datasets it hasn't yet, or which failed")
     g1.add_argument('-p', '--project',
                        required=True,
                        action='append', help='Project, eg "CMIP5"')
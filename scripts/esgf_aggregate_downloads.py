@@ -0,0 +1,45 @@
+#!/usr/bin/python
+
+import sys
+import logging
+import argparse
+
+import esgf_download
+from esgf_download.aggregate import aggregate_downloads
+
+def aggregate(args):
+    logging.basicConfig(stream=args.log_output, level=args.log_level.upper())
+    conn = esgf_download.open_database(args.database)
+    written, failed = aggregate_downloads(conn, args.output_path, args.processes,
+                                          int(args.buffer_size * 1024 * 1024), args.dry_run)
+    conn.close()
+    if not args.dry_run:
+        logging.info("Wrote %d aggregates; %d datasets couldn't be aggregated" % (written, failed))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Concatenate the time-chunked files of each downloaded dataset into one file per dataset, planned from the time ranges in the database')
+    parser.add_argument('-db', '--database',
+                        required=True,
+                        help='Path to database file. REQUIRED')
+    parser.add_argument('-L', '--log-level',
+                        default='info',
+                        choices=['debug', 'info', 'warning', 'error', 'critical'],
+                        help='Logging level desired: "debug", "info", "warning", "error", or "critical"')
+    parser.add_argument('-l', '--log-output',
+                        default=sys.stdout,
+                        help="Logger output destination, file or stream interpretable by the logger class. Defaults to stdout.")
+    parser.add_argument('-o', '--output_path',
+                        required=True,
+                        help='Directory the files were downloaded to. REQUIRED')
+    parser.add_argument('-j', '--processes',
+                        type=int,
+                        help='Number of datasets to aggregate at once. Defaults to the number of CPUs')
+    parser.add_argument('--buffer-size',
+                        type=float, default=4,
+                        help='Megabytes each process copies at a time')
+    parser.add_argument('-n', '--dry-run',
+                        action='store_true',
+                        help='Only list the aggregates which would be written')
+
+    args = parser.parse_args()
+    aggregate(args)
@@ -0,0 +1,83 @@
+#!/usr/bin/python
+
+import os
+import sys
+import time
+import shutil
+import logging
+import argparse
+import resource
+import tempfile
+
+import esgf_download
+from esgf_download.fixtures import generate_fixtures, serve_fixtures, LAYOUTS
+
+def bench_metadata(args):
+    logging.basicConfig(stream=args.log_output, level=args.log_level.upper())
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='esgf_bench_')
+    fixture_path = os.path.join(work_dir, 'fixtures')
+    database_file = os.path.join(work_dir, 'bench.sqlite')
+
+    if not os.path.isfile(os.path.join(fixture_path, 'search.json')):
+        generate_fixtures(fixture_path,
+                          num_datasets=args.datasets,
+                          files_per_dataset=args.files_per_dataset,
+                          replicas=args.replicas,
+                          layouts=args.layout or LAYOUTS,
+                          seed=args.seed)
+    if os.path.isfile(database_file):
+        os.unlink(database_file)
+
+    server = serve_fixtures(fixture_path)
+    timer = esgf_download.PhaseTimer()
+    start = time.time()
+    esgf_download.metadata_update(database_file,
+                                  search_host=server.search_host,
+                                  timer=timer,
+                                  project='CMIP5',
+                                  variable=esgf_download.fixtures.VARIABLES)
+    elapsed = time.time() - start
+    server.shutdown()
+
+    datasets = timer.counts.get('datasets', 0)
+    files = timer.counts.get('files', 0)
+    print("Datasets harvested:  %d (%.1f/s)" % (datasets, datasets / elapsed))
+    print("Files inserted:      %d (%.1f/s)" % (files, files / elapsed))
+    print("Elapsed:             %.2fs" % elapsed)
+    print("Peak memory:         %.1f MB" % (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0))
+    for phase in ['search', 'fetch', 'parse', 'insert']:
+        phase_time = timer.times.get(phase, 0.0)
+        print("  %-8s %8.2fs (%4.1f%%)" % (phase, phase_time, 100.0 * phase_time / elapsed))
+
+    if not args.work_dir:
+        shutil.rmtree(work_dir)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark metadata harvesting against generated fixtures')
+    parser.add_argument('-L', '--log-level',
+                        default='warning',
+                        choices=['debug', 'info', 'warning', 'error', 'critical'],
+                        help='Logging level desired: debug, info, warning, error, or critical')
+    parser.add_argument('-l', '--log-output',
+                        default=sys.stdout,
+                        help="Logger output destination, file or stream interpretable by the logger class. Defaults to stdout.")
+    parser.add_argument('-w', '--work-dir',
+                        help='Directory to keep fixtures and the database in. Fixtures already present are reused. Defaults to a temporary directory which is removed afterwards.')
+    parser.add_argument('-n', '--datasets',
+                        type=int, default=2000,
+                        help='Number of datasets to generate')
+    parser.add_argument('-f', '--files-per-dataset',
+                        type=int, default=10,
+                        help='Number of files per dataset')
+    parser.add_argument('-r', '--replicas',
+                        type=int, default=1,
+                        help='Number of replicas of each dataset')
+    parser.add_argument('--layout',
+                        action='append', choices=LAYOUTS,
+                        help='THREDDS service layout(s) to generate; defaults to all of them')
+    parser.add_argument('--seed',
+                        type=int, default=0,
+                        help='Random seed for fixture generation')
+
+    args = parser.parse_args()
+    bench_metadata(args)
@@ -0,0 +1,32 @@
+#!/usr/bin/python
+
+import sys
+import json
+import socket
+import argparse
+
+def send_command(args):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(args.control_socket)
+    sock.sendall(" ".join(args.command) + "\n")
+    reply = json.loads(sock.makefile().readline())
+    sock.close()
+    print(json.dumps(reply, indent=2, sort_keys=True))
+    if 'error' in reply:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Control a running ESGF Data Downloader',
+                                     epilog='Commands: "status"; "set max_total_threads <n>"; ' +
+                                     '"set threads_per_host <n>"; "set host <datanode> <n>"; ' +
+                                     '"set spawn_interval <s>"; "set host_spawn_interval <datanode> <s>"; ' +
+                                     '"pause <datanode>"; "resume <datanode>"; "drain"')
+    parser.add_argument('-c', '--control_socket',
+                        required=True,
+                        help='Control socket the downloader was started with. REQUIRED')
+    parser.add_argument('command',
+                        nargs='+',
+                        help='Command to send')
+
+    args = parser.parse_args()
+    send_command(args)
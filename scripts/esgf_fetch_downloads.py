@@ -4,7 +4,7 @@ import logging
 import sys
 import argparse
 
-from esgf_download import Downloader
+from esgf_download import Downloader, plan_downloads
 
 def test_download():
     logging.basicConfig(stream=sys.stdout, level=4)
@@ -13,6 +13,30 @@ def test_download():
                                      initial_threads_per_host=10, max_total_threads=100)
     downloader.go_get_em()
 
+def format_duration(seconds):
+    if seconds is None:
+        return 'unknown'
+    return '%dd %02d:%02d' % (seconds // 86400, seconds % 86400 // 3600, seconds % 3600 // 60)
+
+def plan(args):
+    plan = plan_downloads(args.database, args.initial_threads_per_host, args.max_total_threads)
+    print("%-40s %8s %10s %12s %8s %12s" % ('Data node', 'Files', 'GB', 'MB/s/thread', 'Threads', 'Finishes'))
+    for host in plan:
+        rate = '-' if host['rate'] is None else '%.2f%s' % (host['rate'] / 1e6, '*' if host['rate_estimated'] else '')
+        print("%-40s %8d %10.1f %12s %8.1f %12s" % (host['datanode'], host['files'], host['bytes'] / 1e9,
+                                                   rate, host['threads'], format_duration(host['finish'])))
+    finishes = [ host['finish'] for host in plan if host['finish'] is not None ]
+    print("Total: %d files, %.1f GB; projected to take %s" % (
+        sum([ host['files'] for host in plan ]), sum([ host['bytes'] for host in plan ]) / 1e9,
+        format_duration(max(finishes) if len(finishes) > 0 else None)))
+    if len(finishes) > 0:
+        print("Bottleneck: " + plan[0]['datanode'])
+    if any([ host['rate_estimated'] for host in plan ]):
+        print("* No completed transfers from this host; rate assumed to be the mean of the other hosts.")
+    unsized = sum([ host['unsized_files'] for host in plan ])
+    if unsized > 0:
+        print("%d files have no recorded size and are not counted." % unsized)
+
 def download(args):
     logging.basicConfig(stream=vars(args).pop('log_output', None), level=vars(args).pop('log_level', None).upper())
     logging.debug(vars(args))
@@ -28,6 +52,9 @@ if __name__ == '__main__':
     g0.add_argument('-db', '--database',
                         required=True,
                         help='Path to database file. REQUIRED')
+    g0.add_argument('--plan',
+                        action='store_true',
+                        help='Instead of downloading, report the volume each data node will serve and projected completion times from past transfer rates')
     g0.add_argument('-L', '--log-level',
                         default='info',
                         choices=['debug', 'info', 'warning', 'error', 'critical'],
@@ -39,14 +66,11 @@ if __name__ == '__main__':
     # ESGF Update Metadata Options
     g1 = parser.add_argument_group('ESGF Required Download Options')
     g1.add_argument('-o', '--output_path',
-                    required=True,
-                    help='Output directory')
+                    help='Output directory. REQUIRED unless planning')
     g1.add_argument('-u', '--username',
-                    required=True,
-                    help='Authentication username')
+                    help='Authentication username. REQUIRED unless planning')
     g1.add_argument('-p', '--password',
-                    required=True,
-                    help='Authentication password')
+                    help='Authentication password. REQUIRED unless planning')
 
     # Optional Data Download Options
     g2 = parser.add_argument_group('Additional download options')
@@ -59,6 +83,39 @@ if __name__ == '__main__':
     g2.add_argument('-T', '--max_total_threads',
                     type=int, default=50,
                     help='Max total threads')
+    g2.add_argument('-w', '--worker_id',
+                    help='Identifier for this downloader when several share a database. Defaults to hostname:pid')
+    g2.add_argument('--lease_duration',
+                    type=int, default=300,
+                    help='Seconds a claimed transfer stays claimed without renewal before other downloaders may reclaim it')
+    g2.add_argument('-c', '--control_socket',
+                    help='Unix socket to accept commands on while running; see esgf_control_downloads.py')
+    g2.add_argument('-r', '--renew_credentials_before',
+                    type=int, default=3600,
+                    help='Renew credentials this many seconds before they expire')
+    g2.add_argument('-s', '--symlink_root',
+                    help='Root of a symlink tree to update as downloads complete; see esgf_update_symlinks.py')
+    g2.add_argument('--spawn_interval',
+                    type=float, default=0.0,
+                    help='Minimum seconds between starting downloads from any one host')
+    g2.add_argument('--pending_window',
+                    type=int, default=100,
+                    help='Number of waiting transfers per host to hold in memory')
+    g2.add_argument('--digest',
+                    dest='digests', action='append',
+                    help='Digest to compute while downloading and record in the transfert_digest table, eg "sha256". May be given more than once')
+    g2.add_argument('--hedge_threshold',
+                    type=float, default=0.25,
+                    help='Fetch the rest of a transfer over a second connection when it runs slower than this fraction of its host\'s median rate; 0 disables')
+    g2.add_argument('--hedge_after',
+                    type=int, default=60,
+                    help='Seconds a transfer must have been running before it may be hedged')
 
     args = parser.parse_args()
-    download(args)
+    if vars(args).pop('plan'):
+        plan(args)
+    else:
+        for required in ['output_path', 'username', 'password']:
+            if vars(args)[required] is None:
+                parser.error('argument --%s is required' % required)
+        download(args)
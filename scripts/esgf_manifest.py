@@ -0,0 +1,37 @@
+#!/usr/bin/python
+
+import sys
+import logging
+import argparse
+
+import esgf_download
+from esgf_download.manifest import export_manifest, import_manifest
+
+def manifest(args):
+    logging.basicConfig(stream=args.log_output, level=args.log_level.upper())
+    conn = esgf_download.open_database(args.database)
+    if args.action == 'export':
+        export_manifest(conn, args.manifest)
+    else:
+        import_manifest(conn, args.manifest)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export the transfers in a database to a manifest, or import a manifest into a database')
+    parser.add_argument('action',
+                        choices=['export', 'import'],
+                        help='Whether to export the database to the manifest or import the manifest into the database')
+    parser.add_argument('manifest',
+                        help='Manifest file: JSON lines, or CSV if the name ends in .csv; gzip compressed if the name ends in .gz')
+    parser.add_argument('-db', '--database',
+                        required=True,
+                        help='Path to database file. REQUIRED')
+    parser.add_argument('-L', '--log-level',
+                        default='info',
+                        choices=['debug', 'info', 'warning', 'error', 'critical'],
+                        help='Logging level desired: "debug", "info", "warning", "error", or "critical"')
+    parser.add_argument('-l', '--log-output',
+                        default=sys.stdout,
+                        help="Logger output destination, file or stream interpretable by the logger class. Defaults to stdout.")
+
+    args = parser.parse_args()
+    manifest(args)
@@ -0,0 +1,100 @@
+#!/usr/bin/python
+
+import sys
+import logging
+import argparse
+import itertools
+
+import esgf_download
+from esgf_download.simulator import model_hosts, load_workload, simulate, policies
+
+def format_duration(seconds):
+    if seconds is None:
+        return 'unknown'
+    if seconds < 60:
+        return '%.1fs' % seconds
+    return '%dd %02d:%02d:%02d' % (seconds // 86400, seconds % 86400 // 3600, seconds % 3600 // 60, seconds % 60)
+
+def format_fraction(fraction):
+    return '-' if fraction is None else '%.0f%%' % (100 * fraction)
+
+def simulate_downloads(args):
+    logging.basicConfig(stream=args.log_output, level=args.log_level.upper())
+    conn = esgf_download.open_database(args.database)
+    models = model_hosts(conn, not args.unlimited_bandwidth)
+    workload, unsized = load_workload(conn, None if args.workload == 'all' else ('waiting',))
+    conn.close()
+
+    print("%-40s %12s %12s %10s %8s" % ('Data node', 'MB/s/thread', 'MB/s total', 'Latency', 'Errors'))
+    for datanode, model in sorted(models.items()):
+        print("%-40s %12.2f %12s %9.2fs %8s" % (datanode, model.rate / 1e6,
+            '-' if model.bandwidth is None else '%.2f' % (model.bandwidth / 1e6), model.latency,
+            format_fraction(model.error_rate)))
+    unmodelled = [ datanode for datanode in workload if datanode not in models ]
+    if len(unmodelled) > 0:
+        print("No history for %s; assumed to run at the mean rate of the other hosts." % ", ".join(sorted(unmodelled)))
+    if unsized > 0:
+        print("%d transfers have no recorded size and are not simulated." % unsized)
+    print("")
+
+    results = []
+    for threads_per_host, max_total_threads, policy in itertools.product(
+            args.threads_per_host, args.max_total_threads, args.policy or ['fifo']):
+        result = simulate(models, workload, threads_per_host, max_total_threads, policy,
+                          args.spawn_interval, args.seed)
+        results.append((threads_per_host, max_total_threads, policy, result))
+
+    print("%8s %8s %-16s %16s %8s %10s %10s" % ('Per host', 'Total', 'Policy', 'Makespan', 'Failed', 'Slots', 'Bandwidth'))
+    for threads_per_host, max_total_threads, policy, result in sorted(results, key=lambda r: r[3]['makespan']):
+        hosts = result['hosts']
+        slots = [ host['slot_utilization'] for host in hosts if host['slot_utilization'] is not None ]
+        bandwidth = [ host['bandwidth_utilization'] for host in hosts if host['bandwidth_utilization'] is not None ]
+        print("%8d %8d %-16s %16s %8d %10s %10s" % (threads_per_host, max_total_threads, policy,
+            format_duration(result['makespan']), result['failed'],
+            format_fraction(sum(slots) / len(slots) if len(slots) > 0 else None),
+            format_fraction(sum(bandwidth) / len(bandwidth) if len(bandwidth) > 0 else None)))
+        if args.hosts:
+            for host in hosts:
+                print("    %-40s %8d %10.1f GB %16s %10s %10s%s" % (host['datanode'], host['files'], host['bytes'] / 1e9,
+                    format_duration(host['finish']), format_fraction(host['slot_utilization']),
+                    format_fraction(host['bandwidth_utilization']), '*' if host['estimated'] else ''))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Predict how long downloads will take with different thread limits and scheduling policies, by simulating the Downloader against host models estimated from the transfers already done. Nothing is downloaded.')
+    parser.add_argument('-db', '--database',
+                        required=True,
+                        help="Path to database file. REQUIRED")
+    parser.add_argument('-L', '--log-level',
+                        default='warning',
+                        choices=['debug', 'info', 'warning', 'error', 'critical'],
+                        help='Logging level desired: debug, info, warning, error, or critical')
+    parser.add_argument('-l', '--log-output',
+                        default=sys.stdout,
+                        help="Logger output destination, file or stream interpretable by the logger class. Defaults to stdout.")
+    parser.add_argument('-t', '--threads-per-host',
+                        type=int, nargs='+', default=[3],
+                        help='Thread limit(s) per host to simulate')
+    parser.add_argument('-m', '--max-total-threads',
+                        type=int, nargs='+', default=[100],
+                        help='Global thread limit(s) to simulate')
+    parser.add_argument('-P', '--policy',
+                        nargs='+', choices=sorted(policies.keys()),
+                        help='Order(s) in which to start each host\'s transfers; fifo (the default) is the Downloader\'s')
+    parser.add_argument('--spawn-interval',
+                        type=float, default=0.0,
+                        help="Minimum time in seconds between starting downloads from a host")
+    parser.add_argument('-w', '--workload',
+                        default='waiting', choices=['waiting', 'all'],
+                        help='Simulate the waiting transfers, or replay all of them to compare with how long they took')
+    parser.add_argument('--unlimited-bandwidth',
+                        action='store_true',
+                        help='Don\'t limit hosts to the highest aggregate rate they have been seen to reach')
+    parser.add_argument('--seed',
+                        type=int, default=0,
+                        help='Random seed for choosing which transfers fail')
+    parser.add_argument('-H', '--hosts',
+                        action='store_true',
+                        help='Show each host\'s finishing time and utilization for each simulation')
+
+    args = parser.parse_args()
+    simulate_downloads(args)
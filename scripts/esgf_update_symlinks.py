@@ -0,0 +1,44 @@
+#!/usr/bin/python
+
+import sys
+import time
+import logging
+import argparse
+
+import esgf_download
+from esgf_download.symlinks import SymlinkTree
+
+def update_symlinks(args):
+    logging.basicConfig(stream=args.log_output, level=args.log_level.upper())
+    conn = esgf_download.open_database(args.database)
+    since = None
+    if args.since_hours is not None:
+        since = time.time() - args.since_hours * 3600
+    tree = SymlinkTree(args.output_path, args.symlink_root)
+    num_updated = tree.update_done_since(conn, since)
+    logging.info("Updated links for %d datasets" % num_updated)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Update a symlink tree linking to one file covering the full time range of each downloaded dataset')
+    parser.add_argument('-db', '--database',
+                        required=True,
+                        help='Path to database file. REQUIRED')
+    parser.add_argument('-L', '--log-level',
+                        default='info',
+                        choices=['debug', 'info', 'warning', 'error', 'critical'],
+                        help='Logging level desired: "debug", "info", "warning", "error", or "critical"')
+    parser.add_argument('-l', '--log-output',
+                        default=sys.stdout,
+                        help="Logger output destination, file or stream interpretable by the logger class. Defaults to stdout.")
+    parser.add_argument('-o', '--output_path',
+                        required=True,
+                        help='Directory the files were downloaded to. REQUIRED')
+    parser.add_argument('-s', '--symlink_root',
+                        required=True,
+                        help='Root of the symlink tree. REQUIRED')
+    parser.add_argument('--since_hours',
+                        type=float,
+                        help='Only update datasets with downloads completed in this many past hours. Defaults to all datasets')
+
+    args = parser.parse_args()
+    update_symlinks(args)
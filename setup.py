@@ -11,7 +11,10 @@ setup(
     author='David Bronaugh for the Pacific Climate Impacts Consortium',
     author_email='bronaugh@uvic.ca',
     packages=find_packages(),
-    scripts = [ 'scripts/esgf_add_downloads.py', 'scripts/esgf_fetch_downloads.py' ],
+    scripts = [ 'scripts/esgf_add_downloads.py', 'scripts/esgf_fetch_downloads.py',
+                'scripts/esgf_bench_metadata.py', 'scripts/esgf_control_downloads.py',
+                'scripts/esgf_update_symlinks.py', 'scripts/esgf_manifest.py',
+                'scripts/esgf_simulate_downloads.py', 'scripts/esgf_aggregate_downloads.py' ],
     package_data = { 'esgf_download': [ 'data/schema.sql' ] },
     install_requires = [ 'requests',
                          'esgf-pyclient',